@@ -2,101 +2,373 @@
 import argparse
 import collections
 import datetime
+import functools
 import os
 import re
 import sys
+import time
 import typing as t
 import xml.etree.ElementTree
 
+import archives
 import config
+import index
+import profiling
 import table
 
+if t.TYPE_CHECKING:
+    import cache
+    import ipranges
 
-def scan(path):
+
+# Parser backends: 'etree' looks up every field with ElementTree's find(), and
+# 'fast' walks the children of every element once. 'fast' uses lxml to build the
+# tree if it is installed.
+PARSERS = ('etree', 'fast')
+
+# Reporters do not always use exactly the report's date range in the filename,
+# so filtering by the filename's start date keeps files slightly outside the
+# requested range. The exact filtering happens after parsing.
+SCAN_DATE_SLACK = datetime.timedelta(days=1)
+
+
+def parse_report_filename(filename):
+    """Split a report filename `remote!sender!start!end.xml` into its parts.
+
+    Returns a tuple `(remote, sender, start, end)` with `start` and `end`
+    converted to datetimes, or `None` if the name does not follow the scheme.
+    """
+    if not filename.endswith('.xml'):
+        return None
+    s = filename[:-4].split('!')
+    if len(s) == 4:
+        remote, sender, start, end = s
+    elif len(s) == 5:
+        remote, sender, start, end, _ = s
+    else:
+        return None
+    try:
+        start = datetime.datetime.fromtimestamp(int(start))
+        end = datetime.datetime.fromtimestamp(int(end))
+    except ValueError:
+        return None
+    return remote, sender, start, end
+
+
+def scan(path, domains: t.Optional[t.Collection[str]]=None,
+         from_date: t.Optional[datetime.date]=None, until_date: t.Optional[datetime.date]=None):
+    """Find all reports in `path` and return them sorted by their start time.
+
+    Reports are expected to be named `remote!sender!start!end.xml`, where
+    `sender` is the domain the report is about. Reports contained in monthly
+    archives created by compact.py are listed with the paths returned by
+    `archives.member_path()`. If `domains`, `from_date` or `until_date` are
+    given, files and archive members whose names show that they cannot match
+    these filters are skipped without being opened, and archives of months
+    outside the date range are not opened at all.
+    """
+    if domains is not None:
+        domains = {domain.lower() for domain in domains}
+    if from_date is not None:
+        from_date -= SCAN_DATE_SLACK
+    if until_date is not None:
+        until_date += SCAN_DATE_SLACK
     result = []
+
+    def add(report_path, filename):
+        parts = parse_report_filename(filename)
+        if parts is None:
+            print("Skipping file '{}'...".format(report_path), file=sys.stderr)
+            return
+        remote, sender, start, end = parts
+        if domains is not None and sender and sender.lower() not in domains:
+            return
+        if from_date is not None and start.date() < from_date:
+            return
+        if until_date is not None and start.date() > until_date:
+            return
+        result.append((start, end, sender, remote, report_path))
+
     for dirpath, dirnames, filenames in os.walk(path):
         for filename in filenames:
             if filename.endswith('.xml'):
-                s = filename[:-4].split('!')
-                if len(s) == 4:
-                    remote, sender, start, end = s
-                elif len(s) == 5:
-                    remote, sender, start, end, _ = s
-                else:
-                    print("Skipping file '{}'...".format(os.path.join(dirpath, filename)), file=sys.stderr)
-                    continue
-                start = datetime.datetime.fromtimestamp(int(start))
-                end = datetime.datetime.fromtimestamp(int(end))
-                result.append((start, end, sender, remote, os.path.join(dirpath, filename)))
+                add(os.path.join(dirpath, filename), filename)
+                continue
+            month = archives.archive_month(filename)
+            if month is None:
+                continue
+            if from_date is not None and month[1] < from_date:
+                continue
+            if until_date is not None and month[0] > until_date:
+                continue
+            archive_path = os.path.join(dirpath, filename)
+            try:
+                members = archives.list_reports(archive_path)
+            except Exception as e:
+                print("Skipping archive '{}': {}".format(archive_path, e), file=sys.stderr)
+                continue
+            for member in members:
+                add(archives.member_path(archive_path, member), member)
     return sorted(result)
 
 
-def parse(domain, filename):
-    def get(node, name, default=None, expected=False):
-        child = node.find('{*}' + name)
-        if child is not None:
-            if child.text is None:
-                if expected:
-                    raise Exception('Expected "{0}" to have child "{1}" with text, but found no text!'.format(node, name))
-                return default
-            else:
-                return child.text
-        else:
+def _describe_node(node):
+    # Same as repr() of an ElementTree element, also for lxml elements
+    return '<Element {0!r} at {1:#x}>'.format(node.tag, id(node))
+
+
+def _get_child(node, child, name, default=None, expected=False):
+    if child is not None:
+        if child.text is None:
             if expected:
-                raise Exception('Expected "{0}" to have child "{1}", but found none!'.format(node, name))
+                raise Exception('Expected "{0}" to have child "{1}" with text, but found no text!'.format(_describe_node(node), name))
             return default
+        else:
+            return child.text
+    else:
+        if expected:
+            raise Exception('Expected "{0}" to have child "{1}", but found none!'.format(_describe_node(node), name))
+        return default
+
+
+def _get(node, name, default=None, expected=False):
+    return _get_child(node, node.find('{*}' + name), name, default=default, expected=expected)
+
+
+def _convert_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(int(timestamp))
 
-    def convert_timestamp(timestamp):
-        if timestamp is None:
-            return None
-        return datetime.datetime.fromtimestamp(int(timestamp))
 
-    e = xml.etree.ElementTree.parse(filename).getroot()
-    rm = e.find('{*}report_metadata')
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _parse_header(domain, filename, rm, pp):
     if rm is None:
         raise Exception('File "{0}" has no metadata reporting'.format(filename))
-    rm_org_name = get(rm, 'org_name', None)
+    rm_org_name = _get(rm, 'org_name', None)
     rm_dr = rm.find('{*}date_range')
-    rm_start = convert_timestamp(get(rm_dr, 'begin', expected=True))
-    rm_end = convert_timestamp(get(rm_dr, 'end', expected=True))
-    pp = e.find('{*}policy_published')
+    rm_start = _convert_timestamp(_get(rm_dr, 'begin', expected=True))
+    rm_end = _convert_timestamp(_get(rm_dr, 'end', expected=True))
     if pp is None:
         raise Exception('File "{0}" has no published policy'.format(filename))
-    pp_domain = get(pp, 'domain', expected=True)
-    pp_adkim = get(pp, 'adkim', 'r')
-    pp_aspf = get(pp, 'aspf', 'r')
-    pp_p = get(pp, 'p', 'none')
-    pp_sp = get(pp, 'sp', 'none')
-    pp_pct = int(get(pp, 'pct', '100'))
-    data = []
-    for i, r in enumerate(e.findall('{*}record')):
-        rr = r.find('{*}row')
-        if rr is None:
-            raise Exception('File "{0}" has no row data in record {1}'.format(filename, i + 1))
-        rr_source_ip = get(rr, 'source_ip', expected=True)
-        rr_count = int(get(rr, 'count', 0))
-        rrpe = rr.find('{*}policy_evaluated')
-        if rrpe is None:
-            raise Exception('File "{0}" has no evaluated policy in record {1}'.format(filename, i + 1))
-        rrpe_disposition = get(rrpe, 'disposition', expected=True)
-        rrpe_dkim = get(rrpe, 'dkim', expected=True)
-        rrpe_spf = get(rrpe, 'spf', expected=True)
-        ri = r.find('{*}identifiers')
-        if ri is None:
-            raise Exception('File "{0}" has no identifier in record {1}'.format(filename, i + 1))
-        ri_header_from = get(ri, 'header_from', expected=True)
-        ra = r.find('{*}auth_results')
-        if ra is None:
-            raise Exception('File "{0}" has no authentication results in record {1}'.format(filename, i + 1))
-        auth_results = {}
-        rad = ra.find('{*}dkim')
-        if rad is not None:
-            auth_results['dkim'] = (get(rad, 'domain', None), get(rad, 'result', None))
-        ras = ra.find('{*}spf')
-        if ras is not None:
-            auth_results['spf'] = (get(ras, 'domain', None), get(ras, 'result', None))
-        data.append((rr_source_ip, rr_count, {'disposition': rrpe_disposition, 'dkim': rrpe_dkim, 'spf': rrpe_spf}, ri_header_from, auth_results))
-    return (domain, rm_org_name, rm_start, rm_end, {'domain': pp_domain, 'adkim': pp_adkim, 'aspf': pp_aspf, 'p': pp_p, 'sp': pp_sp, 'pct': pp_pct}, data)
+    pp_domain = _get(pp, 'domain', expected=True)
+    pp_adkim = _get(pp, 'adkim', 'r')
+    pp_aspf = _get(pp, 'aspf', 'r')
+    pp_p = _get(pp, 'p', 'none')
+    pp_sp = _get(pp, 'sp', 'none')
+    pp_pct = int(_get(pp, 'pct', '100'))
+    return (domain, rm_org_name, rm_start, rm_end, {'domain': pp_domain, 'adkim': pp_adkim, 'aspf': pp_aspf, 'p': pp_p, 'sp': pp_sp, 'pct': pp_pct})
+
+
+def _parse_record(filename, i, r):
+    rr = r.find('{*}row')
+    if rr is None:
+        raise Exception('File "{0}" has no row data in record {1}'.format(filename, i + 1))
+    rr_source_ip = _get(rr, 'source_ip', expected=True)
+    rr_count = int(_get(rr, 'count', 0))
+    rrpe = rr.find('{*}policy_evaluated')
+    if rrpe is None:
+        raise Exception('File "{0}" has no evaluated policy in record {1}'.format(filename, i + 1))
+    rrpe_disposition = _get(rrpe, 'disposition', expected=True)
+    rrpe_dkim = _get(rrpe, 'dkim', expected=True)
+    rrpe_spf = _get(rrpe, 'spf', expected=True)
+    ri = r.find('{*}identifiers')
+    if ri is None:
+        raise Exception('File "{0}" has no identifier in record {1}'.format(filename, i + 1))
+    ri_header_from = _get(ri, 'header_from', expected=True)
+    ra = r.find('{*}auth_results')
+    if ra is None:
+        raise Exception('File "{0}" has no authentication results in record {1}'.format(filename, i + 1))
+    auth_results = {}
+    rad = ra.find('{*}dkim')
+    if rad is not None:
+        auth_results['dkim'] = (_get(rad, 'domain', None), _get(rad, 'result', None))
+    ras = ra.find('{*}spf')
+    if ras is not None:
+        auth_results['spf'] = (_get(ras, 'domain', None), _get(ras, 'result', None))
+    return (rr_source_ip, rr_count, {'disposition': rrpe_disposition, 'dkim': rrpe_dkim, 'spf': rrpe_spf}, ri_header_from, auth_results)
+
+
+def _children(node):
+    # Maps the local names of the children of node to the first child with that name
+    children = {}
+    for child in node:
+        tag = child.tag
+        # lxml also returns comments, processing instructions and entities
+        if isinstance(tag, str):
+            name = tag[tag.find('}') + 1:]
+            if name not in children:
+                children[name] = child
+    return children
+
+
+def _parse_record_fast(filename, i, r):
+    # Same as _parse_record(), but looks at the children of every element only once
+    rc = _children(r)
+    rr = rc.get('row')
+    if rr is None:
+        raise Exception('File "{0}" has no row data in record {1}'.format(filename, i + 1))
+    rrc = _children(rr)
+    rr_source_ip = _get_child(rr, rrc.get('source_ip'), 'source_ip', expected=True)
+    rr_count = int(_get_child(rr, rrc.get('count'), 'count', 0))
+    rrpe = rrc.get('policy_evaluated')
+    if rrpe is None:
+        raise Exception('File "{0}" has no evaluated policy in record {1}'.format(filename, i + 1))
+    rrpec = _children(rrpe)
+    rrpe_disposition = _get_child(rrpe, rrpec.get('disposition'), 'disposition', expected=True)
+    rrpe_dkim = _get_child(rrpe, rrpec.get('dkim'), 'dkim', expected=True)
+    rrpe_spf = _get_child(rrpe, rrpec.get('spf'), 'spf', expected=True)
+    ri = rc.get('identifiers')
+    if ri is None:
+        raise Exception('File "{0}" has no identifier in record {1}'.format(filename, i + 1))
+    ri_header_from = _get_child(ri, _children(ri).get('header_from'), 'header_from', expected=True)
+    ra = rc.get('auth_results')
+    if ra is None:
+        raise Exception('File "{0}" has no authentication results in record {1}'.format(filename, i + 1))
+    rac = _children(ra)
+    auth_results = {}
+    for name in ('dkim', 'spf'):
+        node = rac.get(name)
+        if node is not None:
+            nc = _children(node)
+            auth_results[name] = (_get_child(node, nc.get('domain'), 'domain'), _get_child(node, nc.get('result'), 'result'))
+    return (rr_source_ip, rr_count, {'disposition': rrpe_disposition, 'dkim': rrpe_dkim, 'spf': rrpe_spf}, ri_header_from, auth_results)
+
+
+def _open_source(filename, source):
+    # Members of archives share the archive's file handle, so they do not need
+    # to be closed explicitly.
+    if source is not None:
+        return source
+    if archives.split_member_path(filename) is not None:
+        return archives.open_report(filename)
+    return filename
+
+
+def parse(domain, filename, source=None):
+    """Parse the DMARC aggregate report `filename`.
+
+    `filename` can also be a member of an archive as returned by `scan()`. If
+    `source` is given, the report is read from this file-like object instead,
+    and `filename` is only used in error messages.
+    """
+    e = xml.etree.ElementTree.parse(_open_source(filename, source)).getroot()
+    header = _parse_header(domain, filename, e.find('{*}report_metadata'), e.find('{*}policy_published'))
+    data = [_parse_record(filename, i, r) for i, r in enumerate(e.findall('{*}record'))]
+    return header + (data, )
+
+
+@functools.lru_cache(maxsize=None)
+def _import_lxml_etree():
+    # lxml is only imported when the fast parser is used
+    try:
+        import lxml.etree
+    except ImportError:
+        return None
+    return lxml.etree
+
+
+def _parse_tree_fast(source):
+    lxml_etree = _import_lxml_etree()
+    if lxml_etree is None:
+        return xml.etree.ElementTree.parse(source).getroot()
+    try:
+        parser = lxml_etree.XMLParser(resolve_entities=False, no_network=True, remove_comments=True, remove_pis=True, huge_tree=True)
+        return lxml_etree.parse(source, parser).getroot()
+    except lxml_etree.XMLSyntaxError:
+        # Parse again with ElementTree, so that errors are reported like by parse()
+        if not isinstance(source, str):
+            source.seek(0)
+        return xml.etree.ElementTree.parse(source).getroot()
+
+
+def parse_fast(domain, filename, source=None):
+    """Parse a report like `parse()`, but walk the children of every element only once.
+
+    Returns the same result and raises the same errors as `parse()`. Uses
+    lxml to build the tree if it is installed.
+    """
+    e = _parse_tree_fast(_open_source(filename, source))
+    rm = None
+    pp = None
+    records = []
+    for child in e:
+        tag = child.tag
+        if not isinstance(tag, str):
+            continue
+        name = tag[tag.find('}') + 1:]
+        if name == 'record':
+            records.append(child)
+        elif name == 'report_metadata' and rm is None:
+            rm = child
+        elif name == 'policy_published' and pp is None:
+            pp = child
+    header = _parse_header(domain, filename, rm, pp)
+    data = [_parse_record_fast(filename, i, r) for i, r in enumerate(records)]
+    return header + (data, )
+
+
+def _iter_top_level_elements(source):
+    # Yields every direct child of the root element once it is complete, and
+    # detaches it from the root afterwards so that the tree does not grow.
+    depth = 0
+    root = None
+    for event, element in xml.etree.ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield element
+                root.remove(element)
+
+
+def parse_streaming(domain, filename, source=None, fast=False):
+    """Parse a report like `parse()`, but return the records as a generator.
+
+    The records are parsed while the file is read, and every `<record>`
+    element is discarded once it has been converted, so memory usage does not
+    depend on the number of records. Errors in records are raised while
+    iterating over the generator. If `fast` is true, the records are
+    converted like by `parse_fast()`.
+    """
+    parse_record = _parse_record_fast if fast else _parse_record
+    elements = _iter_top_level_elements(_open_source(filename, source))
+    rm = None
+    pp = None
+    pending = []
+    for element in elements:
+        name = _local_name(element.tag)
+        if name == 'report_metadata' and rm is None:
+            rm = element
+        elif name == 'policy_published' and pp is None:
+            pp = element
+        elif name == 'record':
+            # Only happens for reports with records in front of metadata or policy
+            pending.append(element)
+        if rm is not None and pp is not None:
+            break
+    header = _parse_header(domain, filename, rm, pp)
+
+    def records():
+        i = 0
+        for element in pending:
+            yield parse_record(filename, i, element)
+            i += 1
+        pending.clear()
+        for element in elements:
+            if _local_name(element.tag) == 'record':
+                record = parse_record(filename, i, element)
+                element.clear()
+                yield record
+                i += 1
+
+    return header + (records(), )
 
 
 def parse_date(date_str):
@@ -116,31 +388,196 @@ def is_success(result):
     return policy_evaluated['dkim'] == 'pass' and policy_evaluated['spf'] == 'pass' and policy_evaluated['disposition'] == 'none'
 
 
-def prepare_table(files, configuration: config.Configuration, arguments: t.Any):
+def _parse(file, streaming, parser):
+    if streaming:
+        return parse_streaming(file[3], file[4], fast=parser == 'fast')
+    if parser == 'fast':
+        return parse_fast(file[3], file[4])
+    return parse(file[3], file[4])
+
+
+def _parse_file(file, streaming=False, parser='etree'):
+    # Runs in a worker process, so errors are returned as strings instead of being raised.
+    # Also returns the time needed, since the parent process only sees the time it waited.
+    start = time.perf_counter()
+    try:
+        report = _parse(file, streaming, parser)
+        if streaming:
+            report = report[:5] + (list(report[5]), )
+        return report, None, time.perf_counter() - start
+    except Exception as e:
+        return None, str(e), time.perf_counter() - start
+
+
+def _parse_reports(files, report_cache: t.Optional['cache.ReportCache'], streaming: bool, jobs: int, parser: str):
+    # Yields (file, report, error, seconds) for all files, in the order of files. seconds
+    # is the time a worker process needed for parsing, or None if the file was not parsed
+    # by a worker process.
+    if jobs <= 1:
+        for file in files:
+            report = report_cache.get(file[4]) if report_cache is not None else None
+            if report is None:
+                try:
+                    report = _parse(file, streaming and report_cache is None, parser)
+                except Exception as e:
+                    yield file, None, str(e), None
+                    continue
+                if report_cache is not None:
+                    report_cache.put(file[4], report)
+            yield file, report, None, None
+        return
+
+    # Only needed with several jobs, and slow to import
+    import concurrent.futures
+
+    def finish(file, value):
+        if not isinstance(value, concurrent.futures.Future):
+            return file, value, None, None
+        report, error, seconds = value.result()
+        if report is not None and report_cache is not None:
+            report_cache.put(file[4], report)
+        return file, report, error, seconds
+
+    # Only keep a bounded number of parsed reports around that have not been consumed yet
+    window = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for file in files:
+            report = report_cache.get(file[4]) if report_cache is not None else None
+            window.append((file, report if report is not None else executor.submit(_parse_file, file, streaming, parser)))
+            if len(window) > 4 * jobs:
+                yield finish(*window.popleft())
+        while window:
+            yield finish(*window.popleft())
+
+
+def _iter_records(filename, results, accept_record):
+    # Filters the records of a streamed report while they are consumed. Errors can only be
+    # reported at this point, so the records before the error have already been consumed.
+    try:
+        for result in results:
+            if accept_record is None or accept_record(result):
+                yield result
+    except Exception as e:
+        print('Error while parsing {0}: {1}'.format(filename, e), file=sys.stderr)
+
+
+def load_reports(files, report_cache: t.Optional['cache.ReportCache']=None, streaming: bool=False, jobs: int=1,
+                 accept_report: t.Optional[t.Callable[[t.Any], bool]]=None,
+                 accept_record: t.Optional[t.Callable[[t.Any], bool]]=None, profiler=profiling.NULL_PROFILER, parser: str='etree',
+                 lazy_records: bool=False):
+    """Parse the given files and yield `(file, report)` pairs.
+
+    If `report_cache` is given, reports are taken from the cache when it has a
+    current entry, and newly parsed reports are added to it. Otherwise, if
+    `streaming` is true, reports are parsed with `parse_streaming()`. `parser`
+    selects the parser backend from `PARSERS`; 'fast' uses `parse_fast()`. With
+    `jobs` larger than one, files are parsed by that many worker processes;
+    the reports are still yielded in the order of `files`.
+
+    Reports for which `accept_report` returns false are skipped; the function
+    is called before the records are looked at. Only records for which
+    `accept_record` returns true are kept. Files that cannot be parsed are
+    reported on stderr and skipped.
+
+    If `lazy_records` is true, the records of reports parsed with
+    `parse_streaming()` in this process are yielded as an iterator that is
+    parsed and filtered while it is consumed, instead of as a list, so that
+    only the records of one report at a time are kept in memory. It must be
+    consumed before the next report is requested. A report that turns out to
+    be invalid while iterating is then not skipped, but ends early with an
+    error on stderr. Not used with an enabled `profiler`, which needs the
+    number of records.
+
+    The time needed for every file is reported to `profiler` as stage
+    `parse`; it includes filtering the records.
+    """
+    start = time.perf_counter()
+    for file, report, error, seconds in _parse_reports(files, report_cache, streaming, jobs, parser):
+        results = None
+        records = 0
+        if error is not None:
+            print('Error while parsing {0}: {1}'.format(file[4], error), file=sys.stderr)
+        else:
+            try:
+                results = report[5]
+                if profiler.enabled and not isinstance(results, list):
+                    # Count all records, and not only the accepted ones
+                    results = list(results)
+                records = len(results) if isinstance(results, list) else 0
+                if accept_report is not None and not accept_report(report):
+                    results = None
+                elif lazy_records and not isinstance(results, list):
+                    results = _iter_records(file[4], results, accept_record)
+                elif accept_record is not None:
+                    results = [result for result in results if accept_record(result)]
+                elif not isinstance(results, list):
+                    results = list(results)
+            except Exception as e:
+                print('Error while parsing {0}: {1}'.format(file[4], e), file=sys.stderr)
+                results = None
+            profiler.add_file(file[4], time.perf_counter() - start if seconds is None else seconds, records)
+        profiler.add('parse', time.perf_counter() - start, files=1, records=records)
+        if results is not None:
+            yield file, report[:5] + (results, )
+        start = time.perf_counter()
+
+
+def make_report_filter(arguments: t.Any) -> t.Callable[[t.Any], bool]:
+    """Create a function which tells whether a report matches the --domain, --from-date and --until-date options."""
     from_date = parse_date(arguments.from_date)
     until_date = parse_date(arguments.until_date)
 
+    def accept_report(report):
+        start, policy = report[2], report[4]
+        if arguments.domain is not None:
+            if not policy['domain'] in arguments.domain:
+                return False
+        if from_date is not None:
+            if start.date() < from_date:
+                return False
+        if until_date is not None:
+            if start.date() > until_date:
+                return False
+        return True
+
+    return accept_report
+
+
+def make_record_filter(arguments: t.Any) -> t.Optional[t.Callable[[t.Any], bool]]:
+    """Create a function which tells whether a record should be shown according to --all and --only-success."""
+    if arguments.only_success:
+        return is_success
+    elif not arguments.all:
+        return lambda result: not is_success(result)
+    else:
+        return None
+
+
+def prepare_table(files, configuration: config.Configuration, arguments: t.Any, report_cache: t.Optional['cache.ReportCache']=None,
+                  lazy: bool=False, profiler=profiling.NULL_PROFILER, ip_database: t.Optional['ipranges.IPRangeDatabase']=None):
+    """Parse and filter the reports and build the analysis table.
+
+    Returns the table rows and the maximal cell widths to use. If `lazy` is
+    true, the rows are returned as a generator that creates them on demand;
+    the reports are parsed before this function returns in any case. If
+    `ip_database` is given, the AS and country of the source IPs are shown
+    in additional columns.
+    """
+    reports = load_reports(files, report_cache=report_cache, streaming=arguments.streaming, jobs=arguments.jobs,
+                           accept_report=make_report_filter(arguments), accept_record=make_record_filter(arguments),
+                           profiler=profiler, parser=arguments.parser)
+    return build_table(reports, configuration, lazy=lazy, ip_database=ip_database)
+
+
+def build_table(reports, configuration: config.Configuration, lazy: bool=False, ip_database: t.Optional['ipranges.IPRangeDatabase']=None):
+    """Build the analysis table from already filtered `(file, report)` pairs.
+
+    See `prepare_table()` for the return value.
+    """
     data = collections.defaultdict(list)
-    for file in files:
-        try:
-            domain, org_name, start, end, policy, results = parse(file[3], file[4])
-            if arguments.domain is not None:
-                if not policy['domain'] in arguments.domain:
-                    continue
-            if from_date is not None:
-                if start.date() < from_date:
-                    continue
-            if until_date is not None:
-                if start.date() > until_date:
-                    continue
-            if arguments.only_success:
-                results = [result for result in results if is_success(result)]
-            elif not arguments.all:
-                results = [result for result in results if not is_success(result)]
-            if results:
-                data[start.date()].append((file, (domain, org_name, start, end, policy, results)))
-        except Exception as e:
-            print('Error while parsing {0}: {1}'.format(file[4], e), file=sys.stderr)
+    for file, (domain, org_name, start, end, policy, results) in reports:
+        if results:
+            data[start.date()].append((file, (domain, org_name, start, end, policy, results)))
 
     def format_result(result):
         if result is None:
@@ -150,61 +587,223 @@ def prepare_table(files, configuration: config.Configuration, arguments: t.Any):
 
     heading = ('Date', 'Policy and involved domains', '#', 'Source IP', 'Dispos', 'DKIM', 'SPF', 'Header From', 'DKIM auth', 'SPF auth')
     max_cell_width = (None, None, None, None, None, None, None, 20, 30, 25)
+    if ip_database is not None:
+        heading = heading[:4] + ('AS', 'Country') + heading[4:]
+        max_cell_width = max_cell_width[:4] + (30, None) + max_cell_width[4:]
+
+    def format_ip_info(source_ip):
+        info = ip_database.lookup(source_ip)
+        if info is None:
+            return ['---', None]
+        asn, country, description = info
+        return ['AS{0} {1}'.format(asn, description) if description else 'AS{0}'.format(asn), country]
+
+    def rows():
+        yield from (None, None, heading, None, None)
+        for date in sorted(data.keys()):
+            policies = collections.defaultdict(list)
+            for file, (domain, org_name, start, end, policy, results) in data[date]:
+                policies[(policy['adkim'], policy['aspf'], policy['p'], policy['sp'], policy['pct'])].append((file, (domain, org_name, start, end, policy, results)))
+            for policy in sorted(policies.keys()):
+                yield [date, 'adkim={0} aspf={1} p={2} sp={3} pct={4}'.format(*policy)]
+                for file, (domain, org_name, start, end, the_policy, results) in policies[policy]:
+                    field = '{0} ({1}) for {2}'.format(domain, org_name, the_policy['domain'])
+                    for source_ip, count, policy_evaluated, header_from, auth_results in results:
+                        if configuration.identify_own_ips_from_dkim_and_spf:
+                            is_own = (policy_evaluated['dkim'] == 'pass' and policy_evaluated['spf'] == 'pass')
+                        else:
+                            is_own = configuration.is_own_ip(source_ip, date)
+                        row = [None,
+                               field,
+                               count,
+                               (source_ip, 'green' if is_own else 'yellow'),
+                               (policy_evaluated['disposition'][:6], 'green' if (policy_evaluated['disposition'] == 'none') == (is_own or policy[2] == 'none') else 'red'),
+                               (policy_evaluated['dkim'], 'green' if (policy_evaluated['dkim'] == 'pass') == is_own else 'red'),
+                               (policy_evaluated['spf'], 'green' if (policy_evaluated['spf'] == 'pass') == is_own else 'red'),
+                               header_from,
+                               format_result(auth_results.get('{*}dkim', None)),
+                               format_result(auth_results.get('{*}spf', None))]
+                        if ip_database is not None:
+                            row[4:4] = format_ip_info(source_ip)
+                        yield row
+                        field = None
+                    if field is not None:
+                        yield [None, field]
+            yield None
+        yield None
+        yield heading
+        yield None
+        yield None
+
+    if lazy:
+        return rows(), max_cell_width
+    return list(rows()), max_cell_width
+
+
+SUMMARIES = {
+    'day': ('Date', ('date', )),
+    'domain': ('Domain', ('policy_domain', )),
+    'ip': ('Source IP', ('source_ip', )),
+    'org': ('Reporting organization', ('org_name', )),
+}
+
+
+def prepare_summary(files, configuration: config.Configuration, arguments: t.Any, report_cache: t.Optional['cache.ReportCache']=None,
+                    profiler=profiling.NULL_PROFILER):
+    """Parse and filter the reports and build a table with message totals per group.
+
+    The grouping is selected by `arguments.summary`, which must be a key of
+    `SUMMARIES`. All records are counted, independent of --all and
+    --only-success.
+    """
+    reports = load_reports(files, report_cache=report_cache, streaming=arguments.streaming, jobs=arguments.jobs,
+                           accept_report=make_report_filter(arguments), profiler=profiler, parser=arguments.parser,
+                           lazy_records=True)
+    return build_summary(reports, arguments.summary)
+
+
+def build_summary(reports, summary: str):
+    """Build the table for the summary `summary` from already filtered `(file, report)` pairs."""
+    import columnar
+
+    heading_key, columns = SUMMARIES[summary]
+    store = columnar.RecordStore()
+    for file, report in reports:
+        store.add_report(report)
+    return summary_table(heading_key, store.summarize(columns))
+
+
+def summary_table(heading_key: str, groups):
+    """Build a summary table from `(key, messages, success, dkim_pass, spf_pass)` tuples as returned by `columnar.RecordStore.summarize()`."""
+    heading = (heading_key, 'Messages', 'Success', 'Failure', 'DKIM pass', 'SPF pass')
+    max_cell_width = (40, None, None, None, None, None)
     table = [None, None, heading, None, None]
-    for date in sorted(data.keys()):
-        policies = collections.defaultdict(list)
-        for file, (domain, org_name, start, end, policy, results) in data[date]:
-            policies[(policy['adkim'], policy['aspf'], policy['p'], policy['sp'], policy['pct'])].append((file, (domain, org_name, start, end, policy, results)))
-        for policy in sorted(policies.keys()):
-            table.append([date, 'adkim={0} aspf={1} p={2} sp={3} pct={4}'.format(*policy)])
-            for file, (domain, org_name, start, end, the_policy, results) in policies[policy]:
-                field = '{0} ({1}) for {2}'.format(domain, org_name, the_policy['domain'])
-                for source_ip, count, policy_evaluated, header_from, auth_results in results:
-                    if configuration.identify_own_ips_from_dkim_and_spf:
-                        is_own = (policy_evaluated['dkim'] == 'pass' and policy_evaluated['spf'] == 'pass')
-                    else:
-                        is_own = configuration.is_own_ip(source_ip, date)
-                    table.append([None,
-                                  field,
-                                  count,
-                                  (source_ip, 'green' if is_own else 'yellow'),
-                                  (policy_evaluated['disposition'][:6], 'green' if (policy_evaluated['disposition'] == 'none') == (is_own or policy[2] == 'none') else 'red'),
-                                  (policy_evaluated['dkim'], 'green' if (policy_evaluated['dkim'] == 'pass') == is_own else 'red'),
-                                  (policy_evaluated['spf'], 'green' if (policy_evaluated['spf'] == 'pass') == is_own else 'red'),
-                                  header_from,
-                                  format_result(auth_results.get('{*}dkim', None)),
-                                  format_result(auth_results.get('{*}spf', None))])
-                    field = None
-                if field is not None:
-                    table.append([None, field])
-        table.append(None)
-    table.append(None)
-    table.append(heading)
+    for key, messages, success, dkim_pass, spf_pass in groups:
+        table.append([
+            key[0],
+            messages,
+            (success, 'green' if success else None),
+            (messages - success, 'red' if messages > success else None),
+            dkim_pass,
+            spf_pass,
+        ])
     table.append(None)
     table.append(None)
     return table, max_cell_width
 
 
-def main(args):
-    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='DMARC report analyzer.')
-
-    parser.add_argument('-a', '--all', action='store_true', help='Show all records')
-    parser.add_argument('--only-success', action='store_true', help='Show only successful records')
+def add_filter_arguments(parser: argparse.ArgumentParser):
+    """Add the options selecting reports used by `make_report_filter()` to `parser`."""
     parser.add_argument('--domain', action='append', help='Limit to given domains. Specify once per domain')
     parser.add_argument('--from-date', help='Limit reports to ones not before this date. Date must be specified as YYYY-MM-DD.')
     parser.add_argument('--until-date', help='Limit reports to ones not after this date. Date must be specified as YYYY-MM-DD.')
 
+
+def add_parse_arguments(parser: argparse.ArgumentParser):
+    """Add the options controlling how reports are parsed to `parser`. Check them with `check_parse_arguments()`."""
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used for parsing reports. 0 uses one process per CPU')
+    parser.add_argument('--parser', choices=PARSERS, default='etree', help='Parser backend. "fast" looks at every XML element only once, and uses lxml if it is installed (default: %(default)s)')
+
+
+def check_parse_arguments(parser: argparse.ArgumentParser, arguments: t.Any):
+    if arguments.jobs < 0:
+        parser.error('--jobs must not be negative')
+    if arguments.jobs == 0:
+        arguments.jobs = os.cpu_count() or 1
+
+
+def add_report_arguments(parser: argparse.ArgumentParser):
+    """Add the options selecting reports, records and the kind of output to `parser`."""
+    parser.add_argument('-a', '--all', action='store_true', help='Show all records')
+    parser.add_argument('--only-success', action='store_true', help='Show only successful records')
+    add_filter_arguments(parser)
+    parser.add_argument('--summary', choices=sorted(SUMMARIES), help='Instead of listing records, show message totals per day, policy domain, source IP or reporting organization')
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='DMARC report analyzer.')
+
+    add_report_arguments(parser)
+    parser.add_argument('--streaming', action='store_true', help='Parse reports incrementally instead of loading them completely into memory. Has no effect with --cache')
+    parser.add_argument('--stream-output', action='store_true', help='Print the table while it is generated. Column widths are determined from the first rows only')
+    add_parse_arguments(parser)
+    parser.add_argument('--cache', metavar='FILE', help='Keep parsed reports in this SQLite database, so that unchanged files are not parsed again')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Discard all entries of the cache given by --cache before running')
+    index.add_index_arguments(parser)
+    parser.add_argument('--ip-database', metavar='FILE', help='Show AS and country of the source IPs from this IP range database in iptoasn.com TSV format. Ignored with --summary')
+    parser.add_argument('--profile', action='store_true', help='Print time, processed files and records, and peak memory of every stage to stderr')
+    parser.add_argument('--profile-json', metavar='FILE', help='Write the profile as JSON to this file instead of stderr. Implies --profile')
+    parser.add_argument('--profile-slowest', metavar='N', type=int, default=10, help='Number of slowest files to list in the profile (default: %(default)s)')
+
     arguments = parser.parse_args(args[1:])
+    if arguments.rebuild_cache and arguments.cache is None:
+        parser.error('--rebuild-cache requires --cache')
+    check_parse_arguments(parser, arguments)
+    if arguments.profile_slowest < 0:
+        parser.error('--profile-slowest must not be negative')
+
+    profiler = profiling.NULL_PROFILER
+    if arguments.profile or arguments.profile_json is not None:
+        profiler = profiling.Profiler(slowest=arguments.profile_slowest)
 
+    report_cache = None
+    report_index = None
     try:
-        configuration = config.load_config()
-        files = scan('files/')
-        dmarc_table, max_cell_width = prepare_table(files, configuration=configuration, arguments=arguments)
+        with profiler.stage('load_config'):
+            configuration = config.load_config()
+        with profiler.stage('scan'):
+            files = scan('files/', domains=arguments.domain,
+                         from_date=parse_date(arguments.from_date), until_date=parse_date(arguments.until_date))
+        profiler.count('scan', files=len(files))
+        # Only a complete scan tells which files no longer exist
+        complete_scan = arguments.domain is None and arguments.from_date is None and arguments.until_date is None
+        if not arguments.keep_duplicates:
+            with profiler.stage('dedupe'):
+                report_index = index.ReportIndex(arguments.index)
+                if complete_scan:
+                    report_index.prune(file[4] for file in files)
+                files = index.remove_duplicates(files, report_index)
+            profiler.count('dedupe', files=len(files))
+        if arguments.cache is not None:
+            import cache
+
+            report_cache = cache.ReportCache(arguments.cache, rebuild=arguments.rebuild_cache)
+            if complete_scan:
+                report_cache.prune(file[4] for file in files)
+        if arguments.summary is not None:
+            with profiler.stage('prepare_summary'):
+                dmarc_table, max_cell_width = prepare_summary(files, configuration=configuration, arguments=arguments, report_cache=report_cache,
+                                                              profiler=profiler)
+        else:
+            ip_database = None
+            if arguments.ip_database is not None:
+                with profiler.stage('load_ip_database'):
+                    import ipranges
+
+                    ip_database = ipranges.IPRangeDatabase(arguments.ip_database)
+            with profiler.stage('prepare_table'):
+                dmarc_table, max_cell_width = prepare_table(files, configuration=configuration, arguments=arguments, report_cache=report_cache,
+                                                            lazy=arguments.stream_output, profiler=profiler, ip_database=ip_database)
     except ValueError as e:
         print('ERROR: {0}'.format(e), file=sys.stderr)
         return -1
+    finally:
+        if report_cache is not None:
+            report_cache.close()
+        if report_index is not None:
+            report_index.close()
+
+    # With --stream-output, this also includes creating the rows
+    with profiler.stage('format_table'):
+        if arguments.stream_output:
+            table.write_table(dmarc_table, sys.stdout, mode='pretty_text', padding=0, max_cell_width=max_cell_width)
+        else:
+            print(table.format_table(dmarc_table, mode='pretty_text', padding=0, max_cell_width=max_cell_width))
 
-    print(table.format_table(dmarc_table, mode='pretty_text', padding=0, max_cell_width=max_cell_width))
+    if arguments.profile_json is not None:
+        profiler.write_json(arguments.profile_json)
+    elif arguments.profile:
+        profiler.print_report()
     return 0
 
 
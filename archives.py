@@ -0,0 +1,106 @@
+import datetime
+import os
+import re
+import typing as t
+
+if t.TYPE_CHECKING:
+    import zipfile
+
+
+# Monthly archives created by compact.py. The central directory of the ZIP
+# file serves as index: it contains the names of all reports together with
+# the offsets of their compressed data.
+ARCHIVE_NAME_PATTERN = re.compile(r'^reports-([0-9]{4})-([0-9]{2})\.zip$')
+
+_ARCHIVE_SEPARATOR = '.zip' + os.sep
+
+# Archives opened by open_report(), mapping the path to (pid, size, mtime, ZipFile)
+_open_archives = {}
+
+
+def archive_name(date: datetime.date) -> str:
+    """Return the filename of the archive for the month of `date`."""
+    return 'reports-{0:04d}-{1:02d}.zip'.format(date.year, date.month)
+
+
+def archive_month(filename: str) -> t.Optional[t.Tuple[datetime.date, datetime.date]]:
+    """Return the first and last day of the month of the archive `filename`, or `None` if it is no archive name."""
+    m = ARCHIVE_NAME_PATTERN.match(filename)
+    if m is None:
+        return None
+    year, month = int(m.group(1)), int(m.group(2))
+    if not 1 <= month <= 12:
+        return None
+    first = datetime.date(year, month, 1)
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return first, last
+
+
+def member_path(path: str, member: str) -> str:
+    """Return the path used for the report `member` of the archive `path`."""
+    return os.path.join(path, member)
+
+
+def split_member_path(path: str) -> t.Optional[t.Tuple[str, str]]:
+    """Split a path returned by `member_path()` into archive path and member name.
+
+    Returns `None` if `path` is the path of a regular file.
+    """
+    archive_path, sep, member = path.partition(_ARCHIVE_SEPARATOR)
+    if not sep:
+        return None
+    return archive_path + '.zip', member
+
+
+def _get_archive(path: str) -> 'zipfile.ZipFile':
+    # Keeps archives open, so that their central directory is only read once.
+    # The archive is opened again if compact.py has replaced it, and in forked
+    # worker processes, which must not share the file position with the parent.
+    # zipfile is only imported once there are archives, since importing it is slow.
+    import zipfile
+
+    st = os.stat(path)
+    pid = os.getpid()
+    entry = _open_archives.get(path)
+    if entry is not None:
+        archive_pid, size, mtime, archive = entry
+        if (archive_pid, size, mtime) == (pid, st.st_size, st.st_mtime_ns):
+            return archive
+        if archive_pid == pid:
+            archive.close()
+    archive = zipfile.ZipFile(path, mode='r')
+    _open_archives[path] = (pid, st.st_size, st.st_mtime_ns, archive)
+    return archive
+
+
+def list_reports(path: str) -> t.List[str]:
+    """Return the member names of all reports in the archive `path`."""
+    return [info.filename for info in _get_archive(path).infolist() if not info.is_dir()]
+
+
+def open_report(path: str) -> t.BinaryIO:
+    """Open the report `path` for reading in binary mode. `path` can be a regular file or a member of an archive."""
+    parts = split_member_path(path)
+    if parts is None:
+        return open(path, 'rb')
+    return _get_archive(parts[0]).open(parts[1], mode='r')
+
+
+def stat_report(path: str) -> t.Tuple[int, int]:
+    """Return a tuple that changes whenever the content of the report `path` changes.
+
+    For regular files, this is the size and modification time. For members
+    of an archive, this is the uncompressed size and the CRC-32 of the content.
+    Raises `OSError` if the report does not exist.
+    """
+    parts = split_member_path(path)
+    if parts is None:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    import zipfile
+
+    try:
+        info = _get_archive(parts[0]).getinfo(parts[1])
+    except (KeyError, zipfile.BadZipFile):
+        raise FileNotFoundError('Report "{0}" does not exist'.format(path))
+    return info.file_size, info.CRC
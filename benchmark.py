@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import analysis
+import config
+import generate
+import profiling
+import table
+
+
+STAGES = ('scan', 'parse', 'prepare_table', 'format_table')
+
+
+def run_stage(path, stage, own_network, parser='etree'):
+    """Run all stages up to `stage` on the reports in `path` and measure `stage`.
+
+    `prepare_table` only measures building the table from the parsed reports,
+    since parsing is measured by `parse`. Returns a dictionary with the
+    results. The earlier stages run in the same process, so `peak_rss` is
+    the peak of all stages up to `stage`; `rss_increase` is how much `stage`
+    raised that peak. Should be run in a fresh process, so that the peak RSS is not
+    influenced by earlier runs.
+    """
+    configuration = config.Configuration('.', {'own_ips': {own_network: {}}})
+    result = {'stage': stage}
+
+    def timed(name, function):
+        peak_before = profiling.peak_rss()
+        start = time.perf_counter()
+        value = function()
+        if name == stage:
+            result['seconds'] = time.perf_counter() - start
+            result['peak_rss'] = profiling.peak_rss()
+            result['rss_increase'] = result['peak_rss'] - peak_before
+        return value
+
+    files = timed('scan', lambda: analysis.scan(path))
+    result['files'] = len(files)
+    if stage != 'scan':
+        reports = timed('parse', lambda: list(analysis.load_reports(files, parser=parser)))
+        result['records'] = sum(len(report[5]) for file, report in reports)
+    if stage in ('prepare_table', 'format_table'):
+        dmarc_table, max_cell_width = timed('prepare_table', lambda: analysis.build_table(reports, configuration))
+    if stage == 'format_table':
+        timed('format_table', lambda: table.format_table(dmarc_table, mode='pretty_text', padding=0, max_cell_width=max_cell_width))
+    return result
+
+
+def _run_stage_in_subprocess(path, stage, own_network, parser):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_stage, (path, stage, own_network, parser))
+
+
+def parse_sizes(sizes):
+    result = []
+    for size in sizes.split(','):
+        try:
+            files, records = size.split('x')
+            result.append((int(files), int(records)))
+        except ValueError:
+            raise ValueError('Cannot parse size "{0}"; sizes must be given as FILESxRECORDS'.format(size))
+    return result
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='Benchmark the stages of the DMARC report analyzer on synthetic reports.')
+
+    parser.add_argument('--sizes', default='100x100,1000x100', help='Comma-separated list of archive sizes FILESxRECORDS (default: %(default)s)')
+    parser.add_argument('--stage', action='append', choices=STAGES, help='Only run the given stage. Specify once per stage')
+    parser.add_argument('--namespace', choices=sorted(generate.NAMESPACES) + ['mixed'], default='mixed', help='XML namespace of the reports (default: %(default)s)')
+    parser.add_argument('--own-ratio', type=float, default=0.5, help='Fraction of records coming from own IP addresses (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the report generator (default: %(default)s)')
+    parser.add_argument('--directory', help='Generate the reports in subdirectories of this directory and keep them, instead of using a temporary directory')
+    parser.add_argument('--parser', choices=analysis.PARSERS, default='etree', help='Parser backend to use (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results as JSON to this file')
+
+    arguments = parser.parse_args(args[1:])
+    try:
+        sizes = parse_sizes(arguments.sizes)
+    except ValueError as e:
+        parser.error(str(e))
+    stages = arguments.stage or STAGES
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_dir = arguments.directory or tmp_dir
+        for files, records in sizes:
+            path = os.path.join(base_dir, '{0}x{1}-{2}-{3}'.format(files, records, arguments.namespace, arguments.seed))
+            if not os.path.exists(path):
+                generate.generate_files(path, files, seed=arguments.seed, records=records, namespace=arguments.namespace,
+                                        own_ratio=arguments.own_ratio)
+            for stage in stages:
+                result = _run_stage_in_subprocess(path, stage, generate.DEFAULT_OWN_NETWORK, arguments.parser)
+                result['size'] = '{0}x{1}'.format(files, records)
+                results.append(result)
+
+    heading = ('Size', 'Stage', 'Seconds', 'Files/s', 'Records/s', 'Peak RSS (MiB)', 'RSS increase (MiB)')
+    output = [None, heading, None]
+    for result in results:
+        seconds = result['seconds']
+        output.append([
+            result['size'],
+            result['stage'],
+            '{0:.3f}'.format(seconds),
+            '{0:.0f}'.format(result['files'] / seconds) if seconds > 0 else None,
+            '{0:.0f}'.format(result['records'] / seconds) if seconds > 0 and 'records' in result else None,
+            '{0:.1f}'.format(result['peak_rss'] / 1024 / 1024),
+            '{0:.1f}'.format(result['rss_increase'] / 1024 / 1024),
+        ])
+    output.append(None)
+    print(table.format_table(output, mode='text'))
+
+    if arguments.json:
+        with open(arguments.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
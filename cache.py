@@ -0,0 +1,102 @@
+import datetime
+import json
+import sqlite3
+import typing as t
+
+import archives
+
+
+# Increase whenever the structure returned by analysis.parse() changes.
+CACHE_VERSION = 3
+
+
+def _encode_datetime(value: t.Optional[datetime.datetime]) -> t.Optional[float]:
+    # The report's timestamp; unlike the local time, it is unambiguous around DST changes
+    return value.timestamp() if value is not None else None
+
+
+def _decode_datetime(value: t.Optional[float]) -> t.Optional[datetime.datetime]:
+    return datetime.datetime.fromtimestamp(value) if value is not None else None
+
+
+def _encode_report(report) -> str:
+    domain, org_name, start, end, policy, results = report
+    return json.dumps([domain, org_name, _encode_datetime(start), _encode_datetime(end), policy, list(results)])
+
+
+def _decode_report(data: str):
+    # JSON has no tuples, so these are restored to get the same result as analysis.parse()
+    domain, org_name, start, end, policy, results = json.loads(data)
+    results = [
+        (source_ip, count, policy_evaluated, header_from, {key: tuple(value) for key, value in auth_results.items()})
+        for source_ip, count, policy_evaluated, header_from, auth_results in results
+    ]
+    return (domain, org_name, _decode_datetime(start), _decode_datetime(end), policy, results)
+
+
+class ReportCache:
+    """On-disk cache of parsed DMARC reports.
+
+    Entries are keyed by the report's path, and are only used when the size
+    and modification time recorded with them still match the file on disk
+    (see `archives.stat_report()` for reports in archives).
+    The cached value is the normalized output of `analysis.parse()`, stored
+    as JSON.
+    """
+
+    path: str
+
+    def __init__(self, path: str, rebuild: bool=False):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS reports (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, data TEXT)')
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if rebuild or row is None or row[0] != str(CACHE_VERSION):
+            self.invalidate()
+
+    def invalidate(self):
+        """Drop all cached reports."""
+        with self._connection:
+            self._connection.execute('DELETE FROM reports')
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(CACHE_VERSION), ))
+
+    @staticmethod
+    def _stat(filename: str) -> t.Tuple[int, int]:
+        return archives.stat_report(filename)
+
+    def get(self, filename: str) -> t.Optional[t.Any]:
+        """Return the cached parse result for `filename`, or `None` if it is missing or stale."""
+        row = self._connection.execute('SELECT size, mtime, data FROM reports WHERE path = ?', (filename, )).fetchone()
+        if row is None:
+            return None
+        try:
+            if (row[0], row[1]) != self._stat(filename):
+                return None
+        except OSError:
+            return None
+        return _decode_report(row[2])
+
+    def put(self, filename: str, report: t.Any):
+        """Store the parse result `report` for `filename`."""
+        size, mtime = self._stat(filename)
+        self._connection.execute(
+            'INSERT OR REPLACE INTO reports (path, size, mtime, data) VALUES (?, ?, ?, ?)',
+            (filename, size, mtime, _encode_report(report)))
+
+    def prune(self, filenames: t.Iterable[str]):
+        """Remove all entries whose path is not contained in `filenames`."""
+        keep = set(filenames)
+        stale = [(path, ) for path, in self._connection.execute('SELECT path FROM reports') if path not in keep]
+        self._connection.executemany('DELETE FROM reports WHERE path = ?', stale)
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,152 @@
+import array
+import datetime
+import functools
+import typing as t
+
+
+@functools.lru_cache(maxsize=None)
+def _import_numpy():
+    # numpy is only imported when it is needed, since importing it takes longer than most analyses
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class StringColumn:
+    """Column of interned strings, stored as integer codes into `values`."""
+
+    values: t.List[t.Optional[str]]
+
+    def __init__(self):
+        self.values = []
+        self.codes = array.array('q')
+        self._index = {}
+
+    def code(self, value: t.Optional[str]) -> int:
+        """Return the code for `value`, adding it to the categories if necessary."""
+        code = self._index.get(value)
+        if code is None:
+            code = len(self.values)
+            self._index[value] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, value: t.Optional[str]) -> int:
+        """Return the code for `value`, or -1 if it does not occur in the column."""
+        return self._index.get(value, -1)
+
+    def append(self, value: t.Optional[str]):
+        self.codes.append(self.code(value))
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class RecordStore:
+    """Stores the records of parsed reports column-wise.
+
+    Every record is one row. Strings are interned per column, and numbers
+    are kept in `array.array` buffers, so that the columns can be used by
+    NumPy without copying if it is installed.
+    """
+
+    STRING_COLUMNS = ('reporter', 'org_name', 'policy_domain', 'source_ip', 'disposition', 'dkim', 'spf', 'header_from')
+
+    def __init__(self):
+        self.date = array.array('q')
+        self.count = array.array('q')
+        self.strings = {name: StringColumn() for name in self.STRING_COLUMNS}
+
+    def __len__(self):
+        return len(self.date)
+
+    def add_report(self, report):
+        """Add all records of a report as returned by `analysis.parse()`."""
+        domain, org_name, start, end, policy, results = report
+        date = start.date().toordinal()
+        s = self.strings
+        reporter_code = s['reporter'].code(domain)
+        org_name_code = s['org_name'].code(org_name)
+        policy_domain_code = s['policy_domain'].code(policy['domain'])
+        for source_ip, count, policy_evaluated, header_from, auth_results in results:
+            self.date.append(date)
+            self.count.append(count)
+            s['reporter'].codes.append(reporter_code)
+            s['org_name'].codes.append(org_name_code)
+            s['policy_domain'].codes.append(policy_domain_code)
+            s['source_ip'].append(source_ip)
+            s['disposition'].append(policy_evaluated['disposition'])
+            s['dkim'].append(policy_evaluated['dkim'])
+            s['spf'].append(policy_evaluated['spf'])
+            s['header_from'].append(header_from)
+
+    def _key_value(self, column: str, code: int):
+        if column == 'date':
+            return datetime.date.fromordinal(code)
+        return self.strings[column].values[code]
+
+    def summarize(self, columns: t.Sequence[str]) -> t.List[t.Tuple[t.Tuple, int, int, int, int]]:
+        """Group the records by the given columns.
+
+        `columns` can contain 'date' and the names in `STRING_COLUMNS`. For
+        every group, returns a tuple `(key, messages, success, dkim_pass,
+        spf_pass)`, where `key` contains the values of the grouping columns
+        and the other entries are message counts. A message is successful if
+        DKIM and SPF pass and the disposition is 'none'. The groups are sorted
+        by key.
+        """
+        if not len(self):
+            return []
+        numpy = _import_numpy()
+        if numpy is not None:
+            groups = self._summarize_numpy(numpy, columns)
+        else:
+            groups = self._summarize_python(columns)
+        result = [(tuple(self._key_value(column, code) for column, code in zip(columns, key)), ) + tuple(counts) for key, counts in groups]
+        result.sort(key=lambda entry: tuple((value is None, value) for value in entry[0]))
+        return result
+
+    def _code_arrays(self, columns):
+        return [self.date if column == 'date' else self.strings[column].codes for column in columns]
+
+    def _pass_codes(self):
+        s = self.strings
+        return s['dkim'].lookup('pass'), s['spf'].lookup('pass'), s['disposition'].lookup('none')
+
+    def _summarize_numpy(self, numpy, columns):
+        count = numpy.frombuffer(self.count, dtype=numpy.int64)
+        dkim_pass_code, spf_pass_code, none_code = self._pass_codes()
+        dkim_pass = numpy.frombuffer(self.strings['dkim'].codes, dtype=numpy.int64) == dkim_pass_code
+        spf_pass = numpy.frombuffer(self.strings['spf'].codes, dtype=numpy.int64) == spf_pass_code
+        success = dkim_pass & spf_pass & (numpy.frombuffer(self.strings['disposition'].codes, dtype=numpy.int64) == none_code)
+        keys = numpy.stack([numpy.frombuffer(codes, dtype=numpy.int64) for codes in self._code_arrays(columns)], axis=1)
+        unique_keys, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        n = len(unique_keys)
+        totals = numpy.bincount(inverse, weights=count, minlength=n)
+        successes = numpy.bincount(inverse, weights=count * success, minlength=n)
+        dkim_passes = numpy.bincount(inverse, weights=count * dkim_pass, minlength=n)
+        spf_passes = numpy.bincount(inverse, weights=count * spf_pass, minlength=n)
+        return [
+            (tuple(int(code) for code in key), (int(totals[i]), int(successes[i]), int(dkim_passes[i]), int(spf_passes[i])))
+            for i, key in enumerate(unique_keys)
+        ]
+
+    def _summarize_python(self, columns):
+        dkim_pass_code, spf_pass_code, none_code = self._pass_codes()
+        s = self.strings
+        groups = {}
+        for key, count, dkim, spf, disposition in zip(zip(*self._code_arrays(columns)), self.count, s['dkim'].codes, s['spf'].codes, s['disposition'].codes):
+            counts = groups.get(key)
+            if counts is None:
+                counts = groups[key] = [0, 0, 0, 0]
+            counts[0] += count
+            if dkim == dkim_pass_code:
+                counts[2] += count
+            if spf == spf_pass_code:
+                counts[3] += count
+            if dkim == dkim_pass_code and spf == spf_pass_code and disposition == none_code:
+                counts[1] += count
+        return list(groups.items())
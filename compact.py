@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+import argparse
+import collections
+import os
+import shutil
+import sys
+import zipfile
+import zlib
+
+import analysis
+import archives
+import extract
+
+
+# Files are read in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+def _crc32(filename):
+    crc = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def compact_files(archive_path, filenames):
+    """Add the reports `filenames` to the archive `archive_path` and delete them.
+
+    The archive is updated in a temporary copy, which replaces the archive
+    once it is complete, so that an interrupted run never damages an archive.
+    Files that are already contained in the archive with the same content are
+    deleted; files contained with different content are kept. Returns the
+    list of deleted files.
+    """
+    # Created with the default permissions, so that new archives are readable like extracted reports
+    fd, tmp_path = extract.create_temp_file(archive_path)
+    os.close(fd)
+    deleted = []
+    try:
+        if os.path.exists(archive_path):
+            shutil.copyfile(archive_path, tmp_path)
+            shutil.copymode(archive_path, tmp_path)
+        with zipfile.ZipFile(tmp_path, mode='a', compression=zipfile.ZIP_DEFLATED) as archive:
+            existing = {info.filename: info for info in archive.infolist()}
+            for filename in filenames:
+                member = os.path.basename(filename)
+                info = existing.get(member)
+                if info is not None:
+                    if (info.file_size, info.CRC) != (os.path.getsize(filename), _crc32(filename)):
+                        print("WARNING: Archive '{}' already contains a different '{}', keeping the file!".format(archive_path, member))
+                        continue
+                else:
+                    archive.write(filename, member)
+                deleted.append(filename)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, archive_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    for filename in deleted:
+        os.unlink(filename)
+    return deleted
+
+
+def compact(path, before=None):
+    """Move all reports in `path` into monthly archives.
+
+    Every report is added to the archive for the month of its start date in
+    the directory containing it. If `before` is given, only reports starting
+    before that date are moved.
+    """
+    months = collections.defaultdict(list)
+    for start, end, sender, remote, filename in analysis.scan(path):
+        if archives.split_member_path(filename) is not None:
+            continue
+        if before is not None and start.date() >= before:
+            continue
+        months[os.path.join(os.path.dirname(filename), archives.archive_name(start.date()))].append(filename)
+    for archive_path in sorted(months):
+        try:
+            deleted = compact_files(archive_path, months[archive_path])
+            print('Added {} reports to {}.'.format(len(deleted), archive_path))
+        except Exception as e:
+            print("Error while updating archive '{}': {}".format(archive_path, e))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='Move the DMARC reports in files/ into monthly archives.')
+
+    parser.add_argument('--before', help='Only move reports starting before this date. Date must be specified as YYYY-MM-DD.')
+
+    arguments = parser.parse_args(args[1:])
+    try:
+        before = analysis.parse_date(arguments.before)
+    except ValueError as e:
+        parser.error(str(e))
+
+    compact('files/', before=before)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
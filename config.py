@@ -1,10 +1,10 @@
 import datetime
+import ipaddress
+import json
 import os
-import subprocess
+import re
 import typing as t
 
-import yaml
-
 
 class DateRange:
     start: t.Optional[datetime.date]
@@ -24,14 +24,64 @@ class DateRange:
         return True
 
 
+class IPNetworkIndex:
+    """Maps IP networks to date ranges and finds all networks containing an address.
+
+    Networks are stored in one hash table per prefix length, keyed by the
+    network prefix. A lookup thus needs one dictionary access per distinct
+    prefix length, independent of the number of networks.
+    """
+
+    def __init__(self):
+        # IP version -> prefix length -> network prefix -> date ranges
+        self._tables = {4: {}, 6: {}}
+
+    def add(self, network: t.Union[ipaddress.IPv4Network, ipaddress.IPv6Network], date_range: DateRange):
+        tables = self._tables[network.version]
+        table = tables.get(network.prefixlen)
+        if table is None:
+            table = tables[network.prefixlen] = {}
+        key = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+        table.setdefault(key, []).append(date_range)
+
+    def lookup(self, ip: t.Union[ipaddress.IPv4Address, ipaddress.IPv6Address]) -> t.List[DateRange]:
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        value = int(ip)
+        result = []
+        for prefixlen, table in self._tables[ip.version].items():
+            date_ranges = table.get(value >> (ip.max_prefixlen - prefixlen))
+            if date_ranges is not None:
+                result.extend(date_ranges)
+        return result
+
+
 class SensitiveConfig:
     imap_password: t.Optional[str]
+    imap_passwords: t.Dict[str, str]
 
     def __init__(self, data: t.Any):
         self.imap_password = data.get('imap_password')
+        self.imap_passwords = data.get('imap_passwords') or {}
+
+
+class ImapSource:
+    name: str
+    server: t.Optional[str]
+    folder: t.Optional[str]
+    user: t.Optional[str]
+
+    def __init__(self, name: str, server: t.Optional[str]=None, folder: t.Optional[str]=None, user: t.Optional[str]=None):
+        self.name = name
+        self.server = server
+        self.folder = folder
+        self.user = user
 
 
 def decrypt_sops_file(path: str) -> t.Mapping[str, t.Any]:
+    import subprocess
+    import yaml
+
     command = ["sops", "--decrypt", path]
     process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = process.communicate()
@@ -41,15 +91,23 @@ def decrypt_sops_file(path: str) -> t.Mapping[str, t.Any]:
     return yaml.safe_load(stdout)
 
 
+DEFAULT_IMAP_SOURCE = 'default'
+
+# Increase whenever the format of the configuration cache changes.
+CONFIG_CACHE_VERSION = 2
+
+
 class Configuration:
     config_directory: str
 
     own_ips: t.Dict[str, DateRange]
+    own_ip_index: IPNetworkIndex
     identify_own_ips_from_dkim_and_spf: bool
 
     imap_server: t.Optional[str]
     imap_folder: t.Optional[str]
     imap_user: t.Optional[str]
+    imap_sources: t.List[ImapSource]
 
     _sensitive_config: t.Optional[SensitiveConfig]
 
@@ -58,34 +116,140 @@ class Configuration:
         self._sensitive_config = None
 
         self.own_ips = {}
+        self.own_ip_index = IPNetworkIndex()
+        self._own_ip_cache = {}
         if 'own_ips' in data:
             for ip, ip_data in data['own_ips'].items():
-                self.own_ips[ip] = DateRange(start=ip_data.get('from'), end=ip_data.get('until'))
+                try:
+                    network = ipaddress.ip_network(str(ip), strict=False)
+                except ValueError:
+                    raise ValueError('Invalid IP address or network in own_ips: "{0}"'.format(ip))
+                date_range = DateRange(start=(ip_data or {}).get('from'), end=(ip_data or {}).get('until'))
+                self.own_ips[ip] = date_range
+                self.own_ip_index.add(network, date_range)
         self.identify_own_ips_from_dkim_and_spf = data.get('identify_own_ips_from_dkim_and_spf', False)
 
         self.imap_server = data.get('imap_server')
         self.imap_folder = data.get('imap_folder')
         self.imap_user = data.get('imap_user')
 
+        self.imap_sources = []
+        if self.imap_server or self.imap_folder or self.imap_user:
+            self.imap_sources.append(ImapSource(DEFAULT_IMAP_SOURCE, server=self.imap_server, folder=self.imap_folder, user=self.imap_user))
+        for source_data in data.get('imap_sources') or []:
+            name = source_data.get('name')
+            if not name or not re.match('^[A-Za-z0-9_.]+$', str(name)):
+                raise ValueError('Every entry of imap_sources needs a name consisting of letters, digits, "_" and "."')
+            if any(source.name == name for source in self.imap_sources):
+                raise ValueError('IMAP source name "{0}" is used more than once'.format(name))
+            self.imap_sources.append(ImapSource(name, server=source_data.get('server'), folder=source_data.get('folder'), user=source_data.get('user')))
+
     def _load_sensitive_config(self):
         path = os.path.join(self.config_directory, 'config.sops.yaml')
         data = decrypt_sops_file(path)
         self._sensitive_config = SensitiveConfig(data)
 
     def is_own_ip(self, ip: str, when: t.Union[datetime.datetime, datetime.date]):
-        date_range = self.own_ips.get(ip)
-        if date_range is None:
-            return False
-        return date_range.inside(when)
-
-    def get_imap_password(self) -> t.Optional[str]:
+        if isinstance(when, datetime.datetime):
+            when = when.date()
+        key = (ip, when)
+        result = self._own_ip_cache.get(key)
+        if result is None:
+            try:
+                date_ranges = self.own_ip_index.lookup(ipaddress.ip_address(ip))
+            except ValueError:
+                date_ranges = []
+            result = any(date_range.inside(when) for date_range in date_ranges)
+            self._own_ip_cache[key] = result
+        return result
+
+    def clear_own_ip_cache(self):
+        """Forget the results remembered by `is_own_ip()`, for example for dates that are no longer looked at."""
+        self._own_ip_cache.clear()
+
+    def get_imap_password(self, source: str=DEFAULT_IMAP_SOURCE) -> t.Optional[str]:
         if self._sensitive_config is None:
             self._load_sensitive_config()
 
-        return self._sensitive_config.imap_password
-
-
-def load_config(path='config.yaml') -> Configuration:
-    with open(path, 'rb') as f:
-        data = yaml.safe_load(f)
+        return self._sensitive_config.imap_passwords.get(source) or self._sensitive_config.imap_password
+
+
+def get_config_cache_path(path: str) -> str:
+    """Return the path of the cache of the configuration file `path`."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{0}.cache'.format(name))
+
+
+def _encode_config_value(value):
+    # Dates are the only values YAML can produce that JSON cannot represent
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    raise TypeError('Cannot store {0!r} in the configuration cache'.format(value))
+
+
+def _decode_config_value(value: t.Dict[str, t.Any]):
+    if len(value) == 1:
+        if '__datetime__' in value:
+            return datetime.datetime.fromisoformat(value['__datetime__'])
+        if '__date__' in value:
+            return datetime.date.fromisoformat(value['__date__'])
+    return value
+
+
+def _read_config_cache(cache_path: str, stamp: t.Tuple[int, int]) -> t.Optional[t.Any]:
+    # Returns the cached data of config.yaml, or None if there is no current cache
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f, object_hook=_decode_config_value)
+        if cache['version'] != CONFIG_CACHE_VERSION or cache['stamp'] != list(stamp):
+            return None
+        return cache['data']
+    except Exception:
+        return None
+
+
+def _write_config_cache(cache_path: str, stamp: t.Tuple[int, int], data: t.Any):
+    try:
+        content = json.dumps({'version': CONFIG_CACHE_VERSION, 'stamp': stamp, 'data': data}, default=_encode_config_value)
+    except (TypeError, ValueError):
+        # The configuration contains values that cannot be stored
+        return
+    import tempfile
+
+    directory, name = os.path.split(cache_path)
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix='{0}.'.format(name), suffix='.tmp', dir=directory or '.')
+    except OSError:
+        # For example, the directory is not writable
+        return
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        os.unlink(tmp_path)
+
+
+def load_config(path='config.yaml', use_cache: bool=True) -> Configuration:
+    """Load the configuration from `path`.
+
+    The parsed content of `path` is kept as JSON in a cache file next to it
+    (see `get_config_cache_path()`), which is used instead of parsing the
+    YAML file as long as the size and modification time of `path` do not
+    change. The sensitive configuration is never cached; it is only
+    decrypted with SOPS once an IMAP password is needed.
+    """
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    cache_path = get_config_cache_path(path)
+    data = _read_config_cache(cache_path, stamp) if use_cache else None
+    if data is None:
+        import yaml
+
+        with open(path, 'rb') as f:
+            data = yaml.safe_load(f)
+        if use_cache:
+            _write_config_cache(cache_path, stamp, data)
     return Configuration(os.path.dirname(path), data)
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+import argparse
+import os
+import sys
+
+import analysis
+import archives
+import index
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='Find DMARC reports that are contained more than once in files/.')
+
+    parser.add_argument('--index', metavar='FILE', default=index.DEFAULT_INDEX,
+                        help='Keep content hashes and report IDs in this SQLite database (default: %(default)s)')
+    parser.add_argument('--prune', action='store_true', help='Delete all duplicates, keeping the first copy of every report')
+
+    arguments = parser.parse_args(args[1:])
+
+    files = analysis.scan('files/')
+    with index.ReportIndex(arguments.index) as report_index:
+        report_index.prune(file[4] for file in files)
+        groups = index.find_duplicates(files, report_index)
+        deleted = set()
+        for group in groups:
+            sha256, org_name, report_id = report_index.get(group[0][4])
+            if org_name is not None and report_id is not None:
+                print('Report {0} from {1}:'.format(report_id, org_name))
+            else:
+                print('Report with SHA-256 {0}:'.format(sha256))
+            print('  Keeping {0}'.format(group[0][4]))
+            for file in group[1:]:
+                if arguments.prune and archives.split_member_path(file[4]) is not None:
+                    print('  Duplicate {0} (contained in an archive, not deleted)'.format(file[4]))
+                elif arguments.prune:
+                    os.unlink(file[4])
+                    deleted.add(file[4])
+                    print('  Deleted {0}'.format(file[4]))
+                else:
+                    print('  Duplicate {0}'.format(file[4]))
+        if deleted:
+            report_index.prune(file[4] for file in files if file[4] not in deleted)
+
+    count = sum(len(group) - 1 for group in groups)
+    print('Found {0} duplicate{1} of {2} report{3}.'.format(count, '' if count == 1 else 's', len(groups), '' if len(groups) == 1 else 's'))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
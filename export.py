@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+import argparse
+import csv
+import datetime
+import functools
+import importlib.util
+import json
+import os
+import sys
+import typing as t
+
+import analysis
+import cache
+import index
+
+
+# Name and type of the exported columns; every record of a report is one row
+COLUMNS = (
+    ('file', 'string'),
+    ('reporter', 'string'),
+    ('org_name', 'string'),
+    ('begin', 'timestamp'),
+    ('end', 'timestamp'),
+    ('policy_domain', 'string'),
+    ('policy_adkim', 'string'),
+    ('policy_aspf', 'string'),
+    ('policy_p', 'string'),
+    ('policy_sp', 'string'),
+    ('policy_pct', 'int'),
+    ('source_ip', 'string'),
+    ('count', 'int'),
+    ('disposition', 'string'),
+    ('dkim', 'string'),
+    ('spf', 'string'),
+    ('header_from', 'string'),
+    ('dkim_auth_domain', 'string'),
+    ('dkim_auth_result', 'string'),
+    ('spf_auth_domain', 'string'),
+    ('spf_auth_result', 'string'),
+)
+
+ARROW_FORMATS = ('parquet', 'arrow')
+
+FORMATS = ARROW_FORMATS + ('csv', 'jsonl')
+
+
+@functools.lru_cache(maxsize=None)
+def _import_pyarrow():
+    # pyarrow is only imported when writing Parquet or Arrow, since importing it is slow
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def iter_rows(reports):
+    """Yield one tuple with the values of `COLUMNS` for every record of the `(file, report)` pairs `reports`.
+
+    The begin and end of the reports are converted to UTC, so that the export
+    does not depend on the time zone of the exporting host.
+    """
+    for file, (domain, org_name, start, end, policy, results) in reports:
+        # The reports contain local times; astimezone() interprets them like fromtimestamp() created them
+        start = start.astimezone(datetime.timezone.utc)
+        end = end.astimezone(datetime.timezone.utc)
+        for source_ip, count, policy_evaluated, header_from, auth_results in results:
+            dkim_auth = auth_results.get('dkim', (None, None))
+            spf_auth = auth_results.get('spf', (None, None))
+            yield (file[4], domain, org_name, start, end,
+                   policy['domain'], policy['adkim'], policy['aspf'], policy['p'], policy['sp'], policy['pct'],
+                   source_ip, count, policy_evaluated['disposition'], policy_evaluated['dkim'], policy_evaluated['spf'], header_from,
+                   dkim_auth[0], dkim_auth[1], spf_auth[0], spf_auth[1])
+
+
+def iter_batches(rows, batch_size: int):
+    """Group `rows` into lists of at most `batch_size` rows."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _open_text(path):
+    if path == '-':
+        return sys.stdout, False
+    return open(path, 'w', newline='', encoding='utf-8'), True
+
+
+class CSVWriter:
+    """Writes rows as CSV with a header line to `path`, or to stdout if `path` is `-`."""
+
+    def __init__(self, path: str):
+        self.file, self._close = _open_text(path)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in COLUMNS])
+
+    def write_batch(self, rows: t.List[tuple]):
+        self.writer.writerows(
+            [value.isoformat() if isinstance(value, datetime.datetime) else value for value in row] for row in rows)
+
+    def close(self):
+        if self._close:
+            self.file.close()
+
+
+class JSONLinesWriter:
+    """Writes every row as a JSON object on its own line to `path`, or to stdout if `path` is `-`."""
+
+    def __init__(self, path: str):
+        self.file, self._close = _open_text(path)
+        self.names = [name for name, _ in COLUMNS]
+
+    def write_batch(self, rows: t.List[tuple]):
+        self.file.write(''.join(
+            json.dumps(dict(zip(self.names, row)), default=datetime.datetime.isoformat) + '\n' for row in rows))
+
+    def close(self):
+        if self._close:
+            self.file.close()
+
+
+class ArrowWriter:
+    """Writes rows as Parquet file or Arrow IPC file to `path`. Needs pyarrow."""
+
+    def __init__(self, path: str, format: str='parquet'):
+        self.pyarrow = pyarrow = _import_pyarrow()
+        types = {'string': pyarrow.string(), 'int': pyarrow.int64(), 'timestamp': pyarrow.timestamp('s', tz='UTC')}
+        self.schema = pyarrow.schema([(name, types[type]) for name, type in COLUMNS])
+        self.format = format
+        if format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write_batch(self, rows: t.List[tuple]):
+        pyarrow = self.pyarrow
+        columns = [pyarrow.array(column, type=self.schema.field(i).type) for i, column in enumerate(zip(*rows))]
+        batch = pyarrow.RecordBatch.from_arrays(columns, schema=self.schema)
+        if self.format == 'parquet':
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+def create_writer(path: str, format: str):
+    """Create a writer for `format`, which must be one of `FORMATS`."""
+    if format in ARROW_FORMATS:
+        if _import_pyarrow() is None:
+            raise ValueError('Format "{0}" needs pyarrow, which is not installed'.format(format))
+        return ArrowWriter(path, format)
+    if format == 'csv':
+        return CSVWriter(path)
+    return JSONLinesWriter(path)
+
+
+def export(reports, writer, batch_size: int=10000) -> int:
+    """Write all records of the `(file, report)` pairs `reports` with `writer` in batches. Returns the number of records."""
+    count = 0
+    for batch in iter_batches(iter_rows(reports), batch_size):
+        writer.write_batch(batch)
+        count += len(batch)
+    return count
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='Export the records of DMARC reports for loading them into other tools.')
+
+    parser.add_argument('output', help='File to write to. Use - to write CSV or JSON Lines to stdout')
+    parser.add_argument('--format', choices=FORMATS, default='parquet' if importlib.util.find_spec('pyarrow') is not None else 'csv',
+                        help='Output format. Parquet and Arrow need pyarrow (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Number of records to write at once (default: %(default)s)')
+    analysis.add_filter_arguments(parser)
+    parser.add_argument('--streaming', action='store_true', help='Parse reports incrementally instead of loading them completely into memory. Has no effect with --cache')
+    analysis.add_parse_arguments(parser)
+    parser.add_argument('--cache', metavar='FILE', help='Use and update the SQLite database with parsed reports of analysis.py --cache')
+    index.add_index_arguments(parser)
+
+    arguments = parser.parse_args(args[1:])
+    if arguments.batch_size < 1:
+        parser.error('--batch-size must be positive')
+    analysis.check_parse_arguments(parser, arguments)
+    if arguments.output == '-' and arguments.format in ARROW_FORMATS:
+        parser.error('Format "{0}" cannot be written to stdout'.format(arguments.format))
+
+    report_cache = None
+    try:
+        files = analysis.scan('files/', domains=arguments.domain,
+                              from_date=analysis.parse_date(arguments.from_date), until_date=analysis.parse_date(arguments.until_date))
+        if not arguments.keep_duplicates:
+            with index.ReportIndex(arguments.index) as report_index:
+                files = index.remove_duplicates(files, report_index)
+        accept_report = analysis.make_report_filter(arguments)
+        writer = create_writer(arguments.output, arguments.format)
+        try:
+            if arguments.cache is not None:
+                report_cache = cache.ReportCache(arguments.cache)
+            reports = analysis.load_reports(files, report_cache=report_cache, streaming=arguments.streaming, jobs=arguments.jobs,
+                                            accept_report=accept_report, parser=arguments.parser, lazy_records=True)
+            count = export(reports, writer, batch_size=arguments.batch_size)
+        finally:
+            writer.close()
+    except ValueError as e:
+        print('ERROR: {0}'.format(e), file=sys.stderr)
+        return -1
+    finally:
+        if report_cache is not None:
+            report_cache.close()
+
+    if arguments.output != '-':
+        print('Exported {0} records to {1}.'.format(count, arguments.output), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
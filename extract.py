@@ -1,68 +1,219 @@
 #!/usr/bin/python3
+import argparse
+import concurrent.futures
+import errno
+import gzip
+import hashlib
+import io
 import os
+import secrets
+import sys
+import typing as t
 import zipfile
-import gzip
 
-import config
+import index
+
+
+# Decompressed data is copied in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+# Errors of os.link() on filesystems without hard links
+_NO_LINK_ERRORS = (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV, errno.ENOSYS)
+
+
+def create_temp_file(path: str) -> t.Tuple[int, str]:
+    """Create a hidden temporary file next to `path`. Returns its file descriptor and its path.
+
+    Unlike `tempfile.mkstemp()`, the file gets the same permissions as a
+    file created with `open()`, that is the ones allowed by the umask.
+    """
+    directory, name = os.path.split(path)
+    while True:
+        tmp_path = os.path.join(directory, '.{0}.{1}.tmp'.format(name, secrets.token_hex(4)))
+        try:
+            return os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), tmp_path
+        except FileExistsError:
+            continue
+
 
+def write_atomically(source, dest_path):
+    """Copy the file-like object `source` to `dest_path`.
+
+    The data is first written to a hidden temporary file next to `dest_path`,
+    which is only linked to `dest_path` once it is complete, or renamed on
+    filesystems without hard links. An existing file is never overwritten.
+    The file gets the permissions allowed by the umask, like with `open()`.
+    Returns the SHA-256 hex digest of the data.
+    """
+    dest_name = os.path.basename(dest_path)
+    if os.path.exists(dest_path):
+        raise Exception("Destination file '{}' already exists!".format(dest_name))
+    fd, tmp_path = create_temp_file(dest_path)
+    h = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            # Unlike rename, link fails if the destination exists
+            os.link(tmp_path, dest_path)
+        except FileExistsError:
+            raise Exception("Destination file '{}' already exists!".format(dest_name))
+        except OSError as e:
+            if e.errno not in _NO_LINK_ERRORS:
+                raise
+            # The filesystem does not support hard links, so rename after checking once more
+            if os.path.exists(dest_path):
+                raise Exception("Destination file '{}' already exists!".format(dest_name))
+            os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return h.hexdigest()
+
+
+def _find_zip_report(f, filename):
+    # Checks that the ZIP archive contains exactly one XML report, and returns
+    # its member name and the filename to extract it to.
+    message_id, real_filename = os.path.basename(filename).split('-', 1)
+    if len(f.namelist()) != 1:
+        raise Exception("ZIP archive '{}' has not precisely one file!".format(filename))
+    member = f.namelist()[0]
+    xmlfile = member
+    if '/' in xmlfile:
+        xmlfile = xmlfile.rsplit('/', 1)[1]
+    if '/' in xmlfile or '\\' in xmlfile:
+        raise Exception("ZIP archive '{}' contains a file '{}' in a subfolder!".format(filename, xmlfile))
+    fn, ext = os.path.splitext(xmlfile)
+    if ext != '.xml':
+        raise Exception("ZIP archive '{}' contains a non-XML file '{}'!".format(filename, xmlfile))
+    bn = os.path.splitext(real_filename)[0]
+    bns = [bn, os.path.splitext(bn)[0]]
+    if fn not in bns:
+        raise Exception("ZIP archive '{}' contains a XML file called '{}', but it should contain one called {}!".format(filename, fn, ' or '.join(["'{}'".format(bn) for bn in bns])))
+    return member, '{}-{}'.format(message_id, xmlfile)
+
+
+def _gzip_report_name(filename):
+    basename = os.path.basename(filename)
+    if basename.endswith('.gz'):
+        return basename[:-len('.gz')]
+    return basename[:-len('.gzip')]
 
-configuration = config.load_config()
 
 def process_zip_file(filename, dest):
-    message_id, real_filename = filename.split('-', 1)
     with zipfile.ZipFile(filename, mode='r') as f:
-        if len(f.namelist()) != 1:
-            raise Exception("ZIP archive '{}' has not precisely one file!".format(filename))
-        xmlfile = f.namelist()[0]
-        if '/' in xmlfile:
-            xmlfile = xmlfile.rsplit('/', 1)[1]
-        if '/' in xmlfile or '\\' in xmlfile:
-            raise Exception("ZIP archive '{}' contains a file '{}' in a subfolder!".format(filename, xmlfile))
-        fn, ext = os.path.splitext(xmlfile)
-        if ext != '.xml':
-            raise Exception("ZIP archive '{}' contains a non-XML file '{}'!".format(filename, xmlfile))
-        bn = os.path.splitext(os.path.basename(real_filename))[0]
-        bns = [bn, os.path.splitext(bn)[0]]
-        if fn not in bns:
-            raise Exception("ZIP archive '{}' contains a XML file called '{}', but it should contain one called {}!".format(filename, fn, ' or '.join(["'{}'".format(bn) for bn in bns])))
-        new_filename = '{}-{}'.format(message_id, xmlfile)
-        if os.path.exists(os.path.join(dest, new_filename)):
-            raise Exception("Destination file '{}' already exists!".format(new_filename))
-        member = f.getinfo(xmlfile)
-        member.filename = new_filename
-        f.extract(member, dest)
+        member, new_filename = _find_zip_report(f, filename)
+        dest_path = os.path.join(dest, new_filename)
+        with f.open(member, mode='r') as source:
+            sha256 = write_atomically(source, dest_path)
     os.unlink(filename)
+    return dest_path, sha256
+
 
 def process_gzip_file(filename, dest):
-    message_id, real_filename = filename.split('-', 1)
-    if filename.endswith('.gz'):
-        xmlfile = filename[:-len('.gz')]
-    else:
-        xmlfile = filename[:-len('.gzip')]
-    with gzip.open(filename, mode='rb') as f:
-        content = f.read()
-    if os.path.exists(os.path.join(dest, xmlfile)):
-        raise Exception("Destination file '{}' already exists!".format(xmlfile))
-    with open(os.path.join(dest, xmlfile), 'wb') as f:
-        f.write(content)
+    dest_path = os.path.join(dest, _gzip_report_name(filename))
+    with gzip.open(filename, mode='rb') as source:
+        sha256 = write_atomically(source, dest_path)
     os.unlink(filename)
+    return dest_path, sha256
+
+
+def extract_report(filename, content):
+    """Decompress a report attachment in memory.
 
-def process(source, dest):
-    for dirpath, _, filenames in os.walk(source):
+    `filename` is the name the attachment would be stored under by `fetch.py`
+    and `content` its data. Performs the same checks as `process_file()`.
+    Returns a tuple `(xml_filename, xml_content)`, or `None` if `filename` is
+    not a ZIP or GZIP file.
+    """
+    if filename.endswith('.zip'):
+        with zipfile.ZipFile(io.BytesIO(content), mode='r') as f:
+            member, new_filename = _find_zip_report(f, filename)
+            return new_filename, f.read(member)
+    if filename.endswith('.gz') or filename.endswith('.gzip'):
+        return _gzip_report_name(filename), gzip.decompress(content)
+    return None
+
+
+def process_file(filename, dest):
+    """Extract the report in the ZIP or GZIP file `filename` to `dest`.
+
+    Returns `None` if `filename` is not a compressed report, and a tuple
+    `(dest_path, sha256)` with the path and the content hash of the extracted
+    report otherwise. Raises an exception on errors.
+    """
+    if filename.endswith('.zip'):
+        return process_zip_file(filename, dest)
+    if filename.endswith('.gz') or filename.endswith('.gzip'):
+        return process_gzip_file(filename, dest)
+    return None
+
+
+def _process_file(filename, dest):
+    # Runs in a worker thread, so errors are returned instead of raised
+    try:
+        return process_file(filename, dest), None
+    except Exception as e:
+        return None, e
+
+
+def find_files(source, dest):
+    """Find all compressed reports in `source`, skipping the directory `dest`."""
+    dest = os.path.realpath(dest)
+    result = []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames[:] = [dirname for dirname in dirnames if os.path.realpath(os.path.join(dirpath, dirname)) != dest]
         for filename in filenames:
-            success = False
-            try:
-                if filename.endswith('.zip'):
-                    process_zip_file(os.path.join(dirpath, filename), dest)
-                    success = True
-                if filename.endswith('.gz') or filename.endswith('.gzip'):
-                    process_gzip_file(os.path.join(dirpath, filename), dest)
-                    success = True
-            except Exception as e:
-                print(e)
-            if success:
-                print('Successfully processed {}.'.format(os.path.join(dirpath, filename)))
-
-source = '.'
-dest = 'files/'
-process(source, dest)
+            if filename.endswith('.zip') or filename.endswith('.gz') or filename.endswith('.gzip'):
+                result.append(os.path.join(dirpath, filename))
+    return sorted(result)
+
+
+def process(source, dest, jobs=1, report_index=None):
+    """Extract all compressed reports in `source` to `dest`, using `jobs` threads.
+
+    If `report_index` is given, the extracted reports are added to it.
+    """
+    filenames = find_files(source, dest)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for filename, (result, error) in zip(filenames, executor.map(_process_file, filenames, [dest] * len(filenames))):
+            if error is not None:
+                print(error)
+            if result is not None:
+                print('Successfully processed {}.'.format(filename))
+                if report_index is not None:
+                    try:
+                        report_index.add(*result)
+                    except Exception as e:
+                        print("WARNING: Cannot add '{}' to the index: {}".format(result[0], e))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='Extract compressed DMARC reports.')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of archives to extract at the same time. 0 uses one thread per CPU')
+    parser.add_argument('--index', metavar='FILE', default=index.DEFAULT_INDEX, help='Add the extracted reports to this index used for finding duplicates (default: %(default)s)')
+    parser.add_argument('--no-index', action='store_true', help='Do not add the extracted reports to an index')
+
+    arguments = parser.parse_args(args[1:])
+    if arguments.jobs < 0:
+        parser.error('--jobs must not be negative')
+    if arguments.jobs == 0:
+        arguments.jobs = os.cpu_count() or 1
+
+    source = '.'
+    dest = 'files/'
+    if arguments.no_index:
+        process(source, dest, jobs=arguments.jobs)
+    else:
+        with index.ReportIndex(arguments.index) as report_index:
+            process(source, dest, jobs=arguments.jobs, report_index=report_index)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
@@ -1,58 +1,375 @@
 #!/usr/bin/python3
+import argparse
+import base64
+import concurrent.futures
+import email.header
 import email.parser
 import email.policy
+import json
 import os
-
-import imapclient
+import quopri
+import sys
+import threading
+import time
+import typing as t
 
 import config
+import table
 
 
-configuration = config.load_config()
+class FetchState:
+    """Remembers UIDVALIDITY and the highest processed UID per IMAP folder.
 
-if not configuration.imap_server:
-    raise Exception('Please configure imap_server!')
-if not configuration.imap_folder:
-    raise Exception('Please configure imap_folder!')
-if not configuration.imap_user:
-    raise Exception('Please configure imap_user!')
-imap_password = configuration.get_imap_password()
-if not imap_password:
-    raise Exception('Please configure imap_password!')
+    The state is stored as JSON in `path`. It can be shared between threads.
+    """
 
-with imapclient.IMAPClient(host=configuration.imap_server) as client:
-    client.login(configuration.imap_user, imap_password)
+    path: str
 
-    # Get unread, undeleted messages
-    client.select_folder(configuration.imap_folder, readonly=True)
-    messages = client.search(['NOT', 'DELETED', 'NOT', 'SEEN'])
-    response = client.fetch(messages, ['RFC822'])
-
-    # Prepare marking messages as read
-    client.select_folder(configuration.imap_folder, readonly=False)
-
-    parser = email.parser.BytesParser(policy=email.policy.default)
-    for message_id, data in response.items():
-        # Parse email
-        email_message = parser.parsebytes(data[b'RFC822'])
-        print('{0}: "{1}", subject: "{2}"'.format(message_id, email_message.get('From'), email_message.get('Subject')))
-
-        # Find attachments
-        if not email_message.is_multipart():
-            email_message.make_mixed()
-        success = False
-        for part in email_message.iter_attachments():
-            # Found attachment. Write to disk.
-            filename = '{0}-{1}'.format(message_id, part.get_filename())
-            if os.path.exists(filename):
-                print('  WARNING: {0} already exists!'.format(filename))
-                continue
-            with open(filename, 'wb') as f:
-                f.write(part.get_content())
-            success = True
-
-        # On success, mark email as read
-        if success:
-            client.add_flags(message_id, imapclient.SEEN, silent=True)
+    def __init__(self, path: str):
+        self.path = path
+        self._data = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._data = json.load(f)
+
+    def get_last_uid(self, folder: str, uidvalidity: int) -> int:
+        """Return the last processed UID in `folder`, or 0 if UIDVALIDITY changed."""
+        with self._lock:
+            entry = self._data.get(folder)
+        if entry is None or entry.get('uidvalidity') != uidvalidity:
+            return 0
+        return entry.get('last_uid', 0)
+
+    def set_last_uid(self, folder: str, uidvalidity: int, last_uid: int):
+        with self._lock:
+            self._data[folder] = {'uidvalidity': uidvalidity, 'last_uid': last_uid}
+            tmp_path = '{0}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as f:
+                json.dump(self._data, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+class FetchStatistics:
+    messages: int
+    attachments: int
+    bytes: int
+    failed_messages: int
+
+    def __init__(self):
+        self.messages = 0
+        self.attachments = 0
+        self.bytes = 0
+        self.failed_messages = 0
+
+
+def _decode_header_value(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    return str(email.header.make_header(email.header.decode_header(value)))
+
+
+def _get_param(params, name):
+    if not params:
+        return None
+    for key, value in zip(params[::2], params[1::2]):
+        if key.upper() == name:
+            return value
+    return None
+
+
+def find_attachments(bodystructure, part=None):
+    """Find attachments in a message's BODYSTRUCTURE.
+
+    Returns a list of `(part, filename, encoding)` tuples, where `part` is the
+    IMAP part specifier (like '2' or '1.3') to fetch.
+    """
+    if bodystructure.is_multipart:
+        result = []
+        for i, child in enumerate(bodystructure[0]):
+            result.extend(find_attachments(child, '{0}.{1}'.format(part, i + 1) if part else str(i + 1)))
+        return result
+    main_type = bodystructure[0].lower()
+    if main_type == b'message':
+        return []
+    encoding = bodystructure[5]
+    # Text parts contain the number of lines before the extension data
+    extension_start = 8 if main_type == b'text' else 7
+    disposition = bodystructure[extension_start + 1] if len(bodystructure) > extension_start + 1 else None
+    filename = None
+    if disposition:
+        filename = _get_param(disposition[1], b'FILENAME')
+    if filename is None:
+        filename = _get_param(bodystructure[2], b'NAME')
+    is_attachment = (disposition and disposition[0].lower() == b'attachment') or main_type == b'application'
+    if filename is None or not is_attachment:
+        return []
+    return [(part or '1', _decode_header_value(filename), (encoding or b'').upper())]
+
+
+def _decode_part(data, encoding):
+    if encoding == b'BASE64':
+        return base64.b64decode(data)
+    if encoding == b'QUOTED-PRINTABLE':
+        return quopri.decodestring(data)
+    return data
+
+
+def _write_attachment(filename, content, log_prefix=''):
+    if os.path.exists(filename):
+        print('{0}  WARNING: {1} already exists!'.format(log_prefix, filename))
+        return False
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return True
+
+
+def _iter_message_attachments(message):
+    # Parse email and find attachments
+    email_message = email.parser.BytesParser(policy=email.policy.default).parsebytes(message)
+    if not email_message.is_multipart():
+        email_message.make_mixed()
+    for part in email_message.iter_attachments():
+        yield part.get_filename(), part.get_content()
+
+
+def fetch_attachments(client, uids, full_messages=False):
+    """Download the attachments of the given messages.
+
+    Yields `(uid, envelope, attachments)` for every message, where
+    `attachments` is a list of `(filename, content)` pairs. Unless
+    `full_messages` is true, only the body parts found via BODYSTRUCTURE are
+    downloaded; messages without recognizable attachments are downloaded
+    completely.
+    """
+    structures = {}
+    if not full_messages:
+        for uid, data in client.fetch(uids, ['ENVELOPE', 'BODYSTRUCTURE']).items():
+            structures[uid] = (data.get(b'ENVELOPE'), find_attachments(data[b'BODYSTRUCTURE']))
+    else:
+        for uid, data in client.fetch(uids, ['ENVELOPE']).items():
+            structures[uid] = (data.get(b'ENVELOPE'), [])
+
+    # Fetch messages with the same attachment part numbers together
+    by_parts = {}
+    for uid in uids:
+        if uid in structures:
+            by_parts.setdefault(tuple(part for part, _, _ in structures[uid][1]), []).append(uid)
+    responses = {}
+    for parts, part_uids in by_parts.items():
+        if parts:
+            responses.update(client.fetch(part_uids, ['BODY.PEEK[{0}]'.format(part) for part in parts]))
+        else:
+            responses.update(client.fetch(part_uids, ['BODY.PEEK[]']))
+
+    for uid in uids:
+        if uid not in structures:
+            continue
+        envelope, attachments = structures[uid]
+        data = responses.pop(uid, {})
+        if attachments:
+            contents = [
+                (filename, _decode_part(data.get('BODY[{0}]'.format(part).encode('ascii'), b''), encoding))
+                for part, filename, encoding in attachments
+            ]
         else:
-            print('  WARNING: cound not extract attachment!')
+            contents = list(_iter_message_attachments(data.get(b'BODY[]', b'')))
+        yield uid, envelope, contents
+
+
+def _describe_envelope(envelope):
+    if envelope is None:
+        return '"", subject: ""'
+    sender = ''
+    if envelope.from_:
+        address = envelope.from_[0]
+        sender = '{0}@{1}'.format(_decode_header_value(address.mailbox or b''), _decode_header_value(address.host or b''))
+        if address.name:
+            sender = '{0} <{1}>'.format(_decode_header_value(address.name), sender)
+    subject = _decode_header_value(envelope.subject or b'')
+    return '"{0}", subject: "{1}"'.format(sender, subject)
+
+
+def fetch_folder(client, folder: str, state: t.Optional[FetchState]=None, batch_size: int=50, full_messages: bool=False,
+                 state_key: t.Optional[str]=None, filename_prefix: str='', log_prefix: str='',
+                 handle_attachment: t.Optional[t.Callable[[str, bytes, str], bool]]=None) -> FetchStatistics:
+    """Store the attachments of all unread, undeleted messages in `folder` in the current directory.
+
+    `client` must be a logged in `imapclient.IMAPClient` or an object with
+    the same interface. Messages are processed in batches of `batch_size`.
+    If `state` is given, only messages with a UID larger than the last one
+    processed in an earlier run are considered, and the state is updated
+    after every batch under `state_key` (default: the folder name). The
+    state never moves past a message that could not be processed, so that
+    it is tried again in the next run. Successfully processed messages are
+    marked as read.
+
+    Attachments are stored as `<prefix><uid>-<filename>`, and all output is
+    prefixed with `log_prefix`. If `handle_attachment` is given, it is called
+    with the name, the content and `log_prefix` instead of writing the
+    attachment to disk, and must return whether it processed it
+    successfully. Returns statistics on the processed messages.
+    """
+    if handle_attachment is None:
+        handle_attachment = _write_attachment
+    if state_key is None:
+        state_key = folder
+    statistics = FetchStatistics()
+    select_info = client.select_folder(folder, readonly=False)
+    uidvalidity = select_info.get(b'UIDVALIDITY')
+    last_uid = state.get_last_uid(state_key, uidvalidity) if state is not None else 0
+
+    # Get unread, undeleted messages
+    criteria = ['NOT', 'DELETED', 'NOT', 'SEEN']
+    if last_uid:
+        criteria = ['UID', '{0}:*'.format(last_uid + 1)] + criteria
+    uids = sorted(uid for uid in client.search(criteria) if uid > last_uid)
+    first_failed_uid = None
+
+    for i in range(0, len(uids), batch_size):
+        batch = uids[i:i + batch_size]
+        for message_id, envelope, attachments in fetch_attachments(client, batch, full_messages=full_messages):
+            print('{0}{1}: {2}'.format(log_prefix, message_id, _describe_envelope(envelope)))
+            statistics.messages += 1
+            success = False
+            for attachment_filename, content in attachments:
+                # Found attachment. Write to disk.
+                if handle_attachment('{0}{1}-{2}'.format(filename_prefix, message_id, attachment_filename), content, log_prefix):
+                    statistics.attachments += 1
+                    statistics.bytes += len(content)
+                    success = True
+
+            # On success, mark email as read
+            if success:
+                client.add_flags(message_id, b'\\Seen', silent=True)
+            else:
+                if first_failed_uid is None:
+                    first_failed_uid = message_id
+                statistics.failed_messages += 1
+                print('{0}  WARNING: cound not extract attachment!'.format(log_prefix))
+        if state is not None:
+            state.set_last_uid(state_key, uidvalidity, batch[-1] if first_failed_uid is None else first_failed_uid - 1)
+    return statistics
+
+
+def fetch_source(source: config.ImapSource, password: str, state: t.Optional[FetchState], batch_size: int, full_messages: bool,
+                 log_prefix: str='', handle_attachment: t.Optional[t.Callable[[str, bytes, str], bool]]=None) -> FetchStatistics:
+    """Open a connection for `source` and fetch its reports with `fetch_folder()`."""
+    import imapclient
+
+    is_default = source.name == config.DEFAULT_IMAP_SOURCE
+    with imapclient.IMAPClient(host=source.server) as client:
+        client.login(source.user, password)
+        return fetch_folder(client, source.folder, state=state, batch_size=batch_size, full_messages=full_messages,
+                            state_key=source.folder if is_default else '{0}:{1}'.format(source.name, source.folder),
+                            filename_prefix='' if is_default else '{0}.'.format(source.name), log_prefix=log_prefix,
+                            handle_attachment=handle_attachment)
+
+
+def get_sources(configuration: config.Configuration, names: t.Optional[t.Collection[str]]=None) -> t.List[t.Tuple[config.ImapSource, str]]:
+    """Return the configured IMAP sources, restricted to `names` if given, together with their passwords."""
+    if not configuration.imap_sources:
+        raise Exception('Please configure imap_server or imap_sources!')
+    sources = []
+    for source in configuration.imap_sources:
+        if names and source.name not in names:
+            continue
+        what = 'imap_' if source.name == config.DEFAULT_IMAP_SOURCE else 'imap_sources[{0}].'.format(source.name)
+        if not source.server:
+            raise Exception('Please configure {0}server!'.format(what))
+        if not source.folder:
+            raise Exception('Please configure {0}folder!'.format(what))
+        if not source.user:
+            raise Exception('Please configure {0}user!'.format(what))
+        imap_password = configuration.get_imap_password(source.name)
+        if not imap_password:
+            raise Exception('Please configure a IMAP password for {0}!'.format(source.name))
+        sources.append((source, imap_password))
+    return sources
+
+
+def _fetch_source_timed(*args):
+    # Also returns the time needed, which must not include the time the task waited for a free thread
+    start = time.monotonic()
+    try:
+        return fetch_source(*args), None, time.monotonic() - start
+    except Exception as e:
+        return None, str(e), time.monotonic() - start
+
+
+def fetch_all(sources: t.List[t.Tuple[config.ImapSource, str]], state: t.Optional[FetchState], jobs: int, batch_size: int, full_messages: bool,
+              handle_attachment: t.Optional[t.Callable[[str, bytes, str], bool]]=None):
+    """Fetch from all `sources` with `fetch_source()`, using up to `jobs` connections at the same time.
+
+    Returns a list of `(source, duration, statistics, error)` tuples.
+    """
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(sources)))) as executor:
+        futures = []
+        for source, imap_password in sources:
+            log_prefix = '[{0}] '.format(source.name) if len(sources) > 1 else ''
+            futures.append((source, executor.submit(
+                _fetch_source_timed, source, imap_password, state, batch_size, full_messages, log_prefix, handle_attachment)))
+        for source, future in futures:
+            statistics, error, duration = future.result()
+            results.append((source, duration, statistics, error))
+    return results
+
+
+def print_statistics(results):
+    """Print the result of `fetch_all()` as a table."""
+    heading = ('Source', 'Messages', 'Attachments', 'KiB', 'KiB/s', 'Failed', 'Error')
+    summary = [None, heading, None]
+    for source, duration, statistics, error in results:
+        if statistics is None:
+            summary.append([source.name, None, None, None, None, None, (error, 'red')])
+            continue
+        summary.append([
+            source.name,
+            statistics.messages,
+            statistics.attachments,
+            statistics.bytes // 1024,
+            '{0:.1f}'.format(statistics.bytes / 1024 / duration) if duration > 0 else None,
+            (statistics.failed_messages, 'yellow') if statistics.failed_messages else 0,
+            None,
+        ])
+    summary.append(None)
+    print(table.format_table(summary, mode='text', max_cell_width=(None, None, None, None, None, None, 60)))
+
+
+def add_fetch_arguments(parser: argparse.ArgumentParser):
+    """Add the options controlling IMAP fetching to `parser`."""
+    parser.add_argument('--state', default='fetch-state.json', help='File to remember the last processed message in (default: %(default)s)')
+    parser.add_argument('--ignore-state', action='store_true', help='Look at all unread messages, not only the ones newer than the last processed one')
+    parser.add_argument('--batch-size', type=int, default=50, help='Number of messages to download at once (default: %(default)s)')
+    parser.add_argument('--full-messages', action='store_true', help='Always download complete messages instead of only the attachments')
+    parser.add_argument('--source', action='append', help='Only fetch from the given IMAP source. Specify once per source')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Maximal number of IMAP sources to fetch from at the same time (default: %(default)s)')
+
+
+def check_fetch_arguments(parser: argparse.ArgumentParser, arguments: t.Any):
+    if arguments.batch_size < 1:
+        parser.error('--batch-size must be positive')
+    if arguments.jobs < 1:
+        parser.error('--jobs must be positive')
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='Fetch DMARC reports from IMAP.')
+    add_fetch_arguments(parser)
+
+    arguments = parser.parse_args(args[1:])
+    check_fetch_arguments(parser, arguments)
+
+    configuration = config.load_config()
+
+    sources = get_sources(configuration, arguments.source)
+    state = None if arguments.ignore_state else FetchState(arguments.state)
+    results = fetch_all(sources, state, arguments.jobs, arguments.batch_size, arguments.full_messages)
+    if len(sources) > 1 or any(error is not None for _, _, _, error in results):
+        print_statistics(results)
+    return 1 if any(error is not None for _, _, _, error in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
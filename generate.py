@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import ipaddress
+import os
+import random
+import sys
+import typing as t
+from xml.sax.saxutils import escape
+
+
+NAMESPACES = {
+    'none': None,
+    'dmarc-0.1': 'http://dmarc.org/dmarc-xml/0.1',
+    'dmarc-2.0': 'urn:ietf:params:xml:ns:dmarc-2.0',
+}
+
+REPORTERS = (
+    ('google.com', 'noreply-dmarc-support@google.com'),
+    ('Yahoo', 'dmarchelp@yahooinc.com'),
+    ('Outlook.com', 'dmarcreport@microsoft.com'),
+    ('Mail.Ru', 'dmarc_support@corp.mail.ru'),
+    ('web.de', 'dmarc@web.de'),
+    ('Fastmail Pty Ltd', 'dmarc-reports@fastmail.com'),
+)
+
+DOMAINS = ('example.com', 'example.org', 'example.net')
+
+DEFAULT_OWN_NETWORK = '192.0.2.0/24'
+
+FOREIGN_NETWORKS = ('198.51.100.0/24', '203.0.113.0/24', '2001:db8:ffff::/48')
+
+
+class ReportGenerator:
+    """Generates synthetic DMARC aggregate reports.
+
+    The output only depends on `seed` and the other arguments. A fraction
+    `own_ratio` of the records has a source IP from `own_network` and
+    mostly passes DKIM and SPF; the other records come from foreign
+    networks and mostly fail. `namespace` is a key of `NAMESPACES`, or
+    'mixed' to pick one randomly per report.
+    """
+
+    def __init__(self, seed: int=0, records: int=100, namespace: str='none', own_ratio: float=0.5,
+                 own_network: str=DEFAULT_OWN_NETWORK, start: datetime.date=datetime.date(2020, 1, 1)):
+        if namespace != 'mixed' and namespace not in NAMESPACES:
+            raise ValueError('Unknown namespace "{0}"'.format(namespace))
+        self.random = random.Random(seed)
+        self.records = records
+        self.namespace = namespace
+        self.own_ratio = own_ratio
+        self.own_network = ipaddress.ip_network(own_network)
+        self.foreign_networks = [ipaddress.ip_network(network) for network in FOREIGN_NETWORKS]
+        self.start = int(datetime.datetime(start.year, start.month, start.day, tzinfo=datetime.timezone.utc).timestamp())
+        self.report_id = 0
+
+    def _random_ip(self, network):
+        return str(network[self.random.randrange(min(network.num_addresses, 1 << 16))])
+
+    def _record(self, domain):
+        rnd = self.random
+        own = rnd.random() < self.own_ratio
+        if own:
+            source_ip = self._random_ip(self.own_network)
+            dkim = 'pass' if rnd.random() < 0.95 else 'fail'
+            spf = 'pass' if rnd.random() < 0.95 else 'fail'
+        else:
+            source_ip = self._random_ip(rnd.choice(self.foreign_networks))
+            dkim = 'pass' if rnd.random() < 0.05 else 'fail'
+            spf = 'pass' if rnd.random() < 0.2 else 'fail'
+        disposition = 'none' if dkim == 'pass' or spf == 'pass' else rnd.choice(('none', 'quarantine', 'reject'))
+        count = rnd.choice((1, 1, 1, 2, 3, 5, 10, 50))
+        return (
+            '<record><row><source_ip>{0}</source_ip><count>{1}</count><policy_evaluated>'
+            '<disposition>{2}</disposition><dkim>{3}</dkim><spf>{4}</spf></policy_evaluated></row>'
+            '<identifiers><header_from>{5}</header_from></identifiers>'
+            '<auth_results><dkim><domain>{5}</domain><result>{3}</result><selector>s1</selector></dkim>'
+            '<spf><domain>{5}</domain><result>{4}</result></spf></auth_results></record>\n'
+        ).format(source_ip, count, disposition, dkim, spf, escape(domain))
+
+    def generate(self, index: int) -> t.Tuple[str, bytes]:
+        """Generate report number `index`.
+
+        Returns the filename in the `remote!sender!start!end.xml` scheme and
+        the XML content.
+        """
+        rnd = self.random
+        org_name, email = rnd.choice(REPORTERS)
+        domain = rnd.choice(DOMAINS)
+        namespace = rnd.choice(sorted(NAMESPACES)) if self.namespace == 'mixed' else self.namespace
+        # Ten reports start per day, so that all filenames are unique
+        begin = self.start + index * 8640
+        end = begin + 86399
+        self.report_id += 1
+        p = rnd.choice(('none', 'none', 'quarantine', 'reject'))
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8" ?>\n',
+            '<feedback xmlns="{0}">\n'.format(NAMESPACES[namespace]) if NAMESPACES[namespace] else '<feedback>\n',
+            '<report_metadata><org_name>{0}</org_name><email>{1}</email><report_id>{2}</report_id>'
+            '<date_range><begin>{3}</begin><end>{4}</end></date_range></report_metadata>\n'.format(
+                escape(org_name), escape(email), self.report_id, begin, end),
+            '<policy_published><domain>{0}</domain><adkim>{1}</adkim><aspf>{2}</aspf><p>{3}</p><sp>{4}</sp>'
+            '<pct>100</pct></policy_published>\n'.format(escape(domain), rnd.choice('rs'), rnd.choice('rs'), p, p),
+        ]
+        for _ in range(self.records):
+            parts.append(self._record(domain))
+        parts.append('</feedback>\n')
+        filename = '{0}!{1}!{2}!{3}.xml'.format(org_name.replace(' ', '_'), domain, begin, end)
+        return filename, ''.join(parts).encode('utf-8')
+
+
+def generate_files(path: str, files: int, **kwargs) -> t.List[str]:
+    """Write `files` synthetic reports to the directory `path` and return their paths.
+
+    The keyword arguments are passed on to `ReportGenerator`.
+    """
+    os.makedirs(path, exist_ok=True)
+    generator = ReportGenerator(**kwargs)
+    result = []
+    for i in range(files):
+        filename, content = generator.generate(i)
+        filename = os.path.join(path, filename)
+        with open(filename, 'wb') as f:
+            f.write(content)
+        result.append(filename)
+    return result
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]), description='Generate synthetic DMARC aggregate reports.')
+
+    parser.add_argument('directory', help='Directory to write the reports to')
+    parser.add_argument('-n', '--files', type=int, default=100, help='Number of reports (default: %(default)s)')
+    parser.add_argument('-r', '--records', type=int, default=100, help='Number of records per report (default: %(default)s)')
+    parser.add_argument('--namespace', choices=sorted(NAMESPACES) + ['mixed'], default='none', help='XML namespace of the reports (default: %(default)s)')
+    parser.add_argument('--own-ratio', type=float, default=0.5, help='Fraction of records coming from own IP addresses (default: %(default)s)')
+    parser.add_argument('--own-network', default=DEFAULT_OWN_NETWORK, help='Network own IP addresses are taken from (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random number generator (default: %(default)s)')
+
+    arguments = parser.parse_args(args[1:])
+
+    filenames = generate_files(arguments.directory, arguments.files, seed=arguments.seed, records=arguments.records,
+                               namespace=arguments.namespace, own_ratio=arguments.own_ratio, own_network=arguments.own_network)
+    print('Generated {0} reports in {1}.'.format(len(filenames), arguments.directory))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
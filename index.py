@@ -0,0 +1,167 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import typing as t
+import xml.etree.ElementTree
+
+import archives
+
+
+DEFAULT_INDEX = 'report-index.sqlite'
+
+# Increase whenever the data stored per file changes.
+INDEX_VERSION = 1
+
+# Files are hashed in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(filename: str) -> str:
+    """Return the SHA-256 hex digest of the content of `filename`."""
+    h = hashlib.sha256()
+    with archives.open_report(filename) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_report_id(filename: str) -> t.Tuple[t.Optional[str], t.Optional[str]]:
+    """Return the organization name and report ID from the `report_metadata` of the report `filename`.
+
+    Only the start of the file up to the end of `report_metadata` is parsed.
+    Returns `(None, None)` if the values cannot be found.
+    """
+    with archives.open_report(filename) as f:
+        try:
+            for event, element in xml.etree.ElementTree.iterparse(f):
+                if element.tag.rsplit('}', 1)[-1] == 'report_metadata':
+                    return element.findtext('{*}org_name'), element.findtext('{*}report_id')
+        except xml.etree.ElementTree.ParseError:
+            pass
+    return None, None
+
+
+class ReportIndex:
+    """On-disk index of the content hashes and report IDs of report files.
+
+    Entries are keyed by the report's path, and are recomputed when the size
+    or modification time of the file no longer match the ones recorded (see
+    `archives.stat_report()` for reports in archives).
+
+    If `path` cannot be written, for example because the directory is read
+    only, a warning is printed and a temporary in-memory index is used.
+    """
+
+    path: str
+
+    def __init__(self, path: str=DEFAULT_INDEX):
+        self.path = path
+        try:
+            self._connection = self._open(path)
+        except sqlite3.Error as e:
+            print('WARNING: Cannot write index "{0}", using a temporary index instead: {1}'.format(path, e), file=sys.stderr)
+            self._connection = self._open(':memory:')
+
+    @staticmethod
+    def _open(path):
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha256 TEXT, org_name TEXT, report_id TEXT)')
+            row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            with connection:
+                if row is None or row[0] != str(INDEX_VERSION):
+                    connection.execute('DELETE FROM files')
+                # Always written, so that an index that cannot be written is detected here
+                connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(INDEX_VERSION), ))
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def add(self, filename: str, sha256: t.Optional[str]=None) -> t.Tuple[str, t.Optional[str], t.Optional[str]]:
+        """Index `filename` and return its `(sha256, org_name, report_id)`.
+
+        If the caller already knows the content hash, it can be passed as
+        `sha256` to avoid reading the file twice.
+        """
+        size, mtime = archives.stat_report(filename)
+        if sha256 is None:
+            sha256 = hash_file(filename)
+        org_name, report_id = read_report_id(filename)
+        self._connection.execute(
+            'INSERT OR REPLACE INTO files (path, size, mtime, sha256, org_name, report_id) VALUES (?, ?, ?, ?, ?, ?)',
+            (os.path.normpath(filename), size, mtime, sha256, org_name, report_id))
+        return sha256, org_name, report_id
+
+    def get(self, filename: str) -> t.Tuple[str, t.Optional[str], t.Optional[str]]:
+        """Return `(sha256, org_name, report_id)` for `filename`, indexing it first if necessary."""
+        row = self._connection.execute(
+            'SELECT size, mtime, sha256, org_name, report_id FROM files WHERE path = ?', (os.path.normpath(filename), )).fetchone()
+        if row is not None:
+            if (row[0], row[1]) == archives.stat_report(filename):
+                return row[2], row[3], row[4]
+        return self.add(filename)
+
+    def prune(self, filenames: t.Iterable[str]):
+        """Remove all entries whose path is not contained in `filenames`."""
+        keep = {os.path.normpath(filename) for filename in filenames}
+        stale = [(path, ) for path, in self._connection.execute('SELECT path FROM files') if path not in keep]
+        self._connection.executemany('DELETE FROM files WHERE path = ?', stale)
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _duplicate_key(entry):
+    sha256, org_name, report_id = entry
+    if org_name is not None and report_id is not None:
+        return ('report', org_name, report_id)
+    return ('sha256', sha256)
+
+
+def find_duplicates(files, report_index: ReportIndex) -> t.List[t.List[t.Any]]:
+    """Find reports in `files` that are contained more than once.
+
+    `files` is a list of tuples as returned by `analysis.scan()`. Two files
+    are duplicates if their `report_metadata` have the same organization name
+    and report ID, or, if these are missing, if their contents are identical.
+    Returns a list of groups of duplicates; the first file of every group is
+    the one that comes first in `files`. Files that cannot be read are
+    ignored, so that they are never removed as duplicates; the error is
+    reported when they are parsed.
+    """
+    groups = {}
+    for file in files:
+        try:
+            key = _duplicate_key(report_index.get(file[4]))
+        except Exception:
+            # For example unknown encodings, or damaged members of archives (zlib.error, BadZipFile)
+            continue
+        groups.setdefault(key, []).append(file)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def remove_duplicates(files, report_index: ReportIndex) -> t.List[t.Any]:
+    """Return `files` without the duplicates found by `find_duplicates()`, keeping the first file of every group."""
+    duplicates = set()
+    for group in find_duplicates(files, report_index):
+        duplicates.update(file[4] for file in group[1:])
+    return [file for file in files if file[4] not in duplicates]
+
+
+def add_index_arguments(parser: argparse.ArgumentParser):
+    """Add the options controlling the removal of duplicate reports to `parser`."""
+    parser.add_argument('--index', metavar='FILE', default=DEFAULT_INDEX,
+                        help='Keep content hashes and report IDs used for finding duplicate reports in this SQLite database (default: %(default)s)')
+    parser.add_argument('--keep-duplicates', action='store_true', help='Also use reports with the same organization and report ID as an earlier report')
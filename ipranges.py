@@ -0,0 +1,86 @@
+import bisect
+import functools
+import gzip
+import ipaddress
+import socket
+import typing as t
+
+
+def _parse_address(address: str) -> t.Tuple[int, int]:
+    # Returns the IP version and the integer value of `address`. Much faster than
+    # ipaddress.ip_address(), which matters for databases with millions of ranges.
+    if ':' in address:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big')
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big')
+
+
+class IPRangeDatabase:
+    """Offline database mapping IP address ranges to AS number, country and AS description.
+
+    Reads files in the format of https://iptoasn.com/ (for example
+    `ip2asn-combined.tsv` or its gzip compressed version): every line has the
+    tab-separated fields `range_start`, `range_end`, `AS_number`,
+    `country_code` and `AS_description`. The ranges are kept sorted per IP
+    version, so that a lookup is a binary search; results for recently seen
+    addresses are cached.
+    """
+
+    def __init__(self, path: str, cache_size: int=65536):
+        self.path = path
+        opener = gzip.open if path.endswith('.gz') else open
+        ranges = {4: [], 6: []}
+        try:
+            f = opener(path, 'rt', encoding='utf-8')
+        except OSError as e:
+            raise ValueError('Cannot open IP range database "{0}": {1}'.format(path, e))
+        with f:
+            for line_no, line in enumerate(f):
+                if not line.strip():
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    version, start = _parse_address(fields[0])
+                    end_version, end = _parse_address(fields[1])
+                    asn = int(fields[2])
+                    if version != end_version:
+                        raise ValueError('IP versions of range start and end differ')
+                except (IndexError, ValueError, OSError):
+                    raise ValueError('Cannot parse line {0} of IP range database "{1}"'.format(line_no + 1, path))
+                if asn == 0:
+                    # Not routed
+                    continue
+                country = fields[3] if len(fields) > 3 and fields[3] not in ('', 'None') else None
+                description = fields[4] if len(fields) > 4 and fields[4] else None
+                ranges[version].append((start, end, (asn, country, description)))
+        # For every IP version, sorted range starts, range ends and values
+        self._starts = {}
+        self._ends = {}
+        self._values = {}
+        for version, entries in ranges.items():
+            entries.sort(key=lambda entry: entry[0])
+            self._starts[version] = [entry[0] for entry in entries]
+            self._ends[version] = [entry[1] for entry in entries]
+            self._values[version] = [entry[2] for entry in entries]
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __len__(self):
+        return sum(len(starts) for starts in self._starts.values())
+
+    def _lookup(self, ip: str) -> t.Optional[t.Tuple[int, t.Optional[str], t.Optional[str]]]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        value = int(address)
+        starts = self._starts[address.version]
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > self._ends[address.version][i]:
+            return None
+        return self._values[address.version][i]
+
+    # Replaced by a cached version of _lookup() in __init__()
+    def lookup(self, ip: str) -> t.Optional[t.Tuple[int, t.Optional[str], t.Optional[str]]]:
+        """Return `(asn, country, description)` for the IP address `ip`, or `None` if it is not contained in any range."""
+        return self._lookup(ip)
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+import argparse
+import io
+import os
+import sys
+import threading
+import typing as t
+
+import analysis
+import config
+import extract
+import fetch
+import table
+
+
+class ReportCollector:
+    """Decompresses and parses report attachments in memory.
+
+    Instances are passed to `fetch.fetch_all()` as `handle_attachment`. The
+    parsed reports accepted by `accept_report` are collected in `reports` as
+    `(file, report)` pairs like the ones returned by `analysis.load_reports()`,
+    with their records filtered by `accept_record`. If `archive` is given,
+    the decompressed XML files are also stored in that directory.
+    """
+
+    reports: t.List[t.Tuple[t.Any, t.Any]]
+
+    def __init__(self, accept_report: t.Callable[[t.Any], bool], accept_record: t.Optional[t.Callable[[t.Any], bool]]=None,
+                 archive: t.Optional[str]=None):
+        self.accept_report = accept_report
+        self.accept_record = accept_record
+        self.archive = archive
+        self.reports = []
+        self._lock = threading.Lock()
+
+    def __call__(self, filename: str, content: bytes, log_prefix: str='') -> bool:
+        try:
+            extracted = extract.extract_report(filename, content)
+            if extracted is None:
+                print("{0}  WARNING: '{1}' is no ZIP or GZIP file!".format(log_prefix, filename))
+                return False
+            xml_filename, xml_content = extracted
+            parts = analysis.parse_report_filename(xml_filename)
+            if parts is None:
+                print("{0}  WARNING: Cannot interpret report name '{1}'!".format(log_prefix, xml_filename))
+                return False
+            remote, sender, start, end = parts
+            path = xml_filename if self.archive is None else os.path.join(self.archive, xml_filename)
+            report = analysis.parse(remote, path, source=io.BytesIO(xml_content))
+        except Exception as e:
+            print('{0}  Error while processing {1}: {2}'.format(log_prefix, filename, e))
+            return False
+
+        if self.archive is not None:
+            try:
+                extract.write_atomically(io.BytesIO(xml_content), path)
+            except Exception as e:
+                print('{0}  WARNING: {1}'.format(log_prefix, e))
+
+        if self.accept_report(report):
+            results = report[5]
+            if self.accept_record is not None:
+                results = [result for result in results if self.accept_record(result)]
+            with self._lock:
+                self.reports.append(((start, end, sender, remote, path), report[:5] + (results, )))
+        return True
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]),
+                                     description='Fetch DMARC reports from IMAP and analyze them without storing intermediate files.')
+    fetch.add_fetch_arguments(parser)
+    analysis.add_report_arguments(parser)
+    parser.add_argument('--archive', metavar='DIRECTORY', help='Also store the extracted XML reports in this directory, for example files/')
+
+    arguments = parser.parse_args(args[1:])
+    fetch.check_fetch_arguments(parser, arguments)
+
+    try:
+        configuration = config.load_config()
+        collector = ReportCollector(analysis.make_report_filter(arguments),
+                                    accept_record=None if arguments.summary else analysis.make_record_filter(arguments),
+                                    archive=arguments.archive)
+    except ValueError as e:
+        print('ERROR: {0}'.format(e), file=sys.stderr)
+        return -1
+
+    sources = fetch.get_sources(configuration, arguments.source)
+    state = None if arguments.ignore_state else fetch.FetchState(arguments.state)
+    results = fetch.fetch_all(sources, state, arguments.jobs, arguments.batch_size, arguments.full_messages,
+                              handle_attachment=collector)
+    if len(sources) > 1 or any(error is not None for _, _, _, error in results):
+        fetch.print_statistics(results)
+
+    reports = sorted(collector.reports, key=lambda entry: entry[0])
+    if arguments.summary is not None:
+        dmarc_table, max_cell_width = analysis.build_summary(reports, arguments.summary)
+    else:
+        dmarc_table, max_cell_width = analysis.build_table(reports, configuration)
+    print(table.format_table(dmarc_table, mode='pretty_text', padding=0, max_cell_width=max_cell_width))
+    return 1 if any(error is not None for _, _, _, error in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
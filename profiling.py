@@ -0,0 +1,139 @@
+import contextlib
+import heapq
+import json
+import resource
+import sys
+import time
+import typing as t
+
+
+def peak_rss() -> int:
+    """Return the peak resident set size of the current process in bytes."""
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageStatistics:
+    seconds: float
+    calls: int
+    files: int
+    records: int
+    peak_rss: int
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.files = 0
+        self.records = 0
+        self.peak_rss = 0
+
+
+class Profiler:
+    """Collects wall time, call counts, processed files and records, and peak memory per stage.
+
+    Time spent in a stage while another stage is running is only counted for
+    the inner stage, so the times of all stages add up to the total runtime.
+    The peak memory is the peak RSS of the process at the end of the stage.
+    The `slowest` files with the longest parsing times are remembered.
+    """
+
+    enabled = True
+
+    def __init__(self, slowest: int=10):
+        self.stages = {}
+        self.slowest = slowest
+        self._slowest_files = []
+        self._stack = []
+
+    def _get(self, name: str) -> StageStatistics:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageStatistics()
+        return stage
+
+    def add(self, name: str, seconds: float, files: int=0, records: int=0):
+        """Account `seconds` of time spent in stage `name` while the current stage was running."""
+        stage = self._get(name)
+        stage.seconds += seconds
+        stage.calls += 1
+        stage.files += files
+        stage.records += records
+        stage.peak_rss = max(stage.peak_rss, peak_rss())
+        if self._stack:
+            self._get(self._stack[-1]).seconds -= seconds
+
+    def add_file(self, filename: str, seconds: float, records: int):
+        """Remember the time needed to parse `filename`."""
+        entry = (seconds, filename, records)
+        if len(self._slowest_files) < self.slowest:
+            heapq.heappush(self._slowest_files, entry)
+        elif self.slowest > 0:
+            heapq.heappushpop(self._slowest_files, entry)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, files: int=0, records: int=0):
+        """Measure the code run in the `with` block as stage `name`."""
+        start = time.perf_counter()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self.add(name, time.perf_counter() - start, files=files, records=records)
+
+    def count(self, name: str, files: int=0, records: int=0):
+        """Add to the file and record counts of stage `name`."""
+        stage = self._get(name)
+        stage.files += files
+        stage.records += records
+
+    def get_report(self) -> t.Dict[str, t.Any]:
+        return {
+            'stages': [
+                {'stage': name, 'seconds': stage.seconds, 'calls': stage.calls, 'files': stage.files,
+                 'records': stage.records, 'peak_rss': stage.peak_rss}
+                for name, stage in self.stages.items()
+            ],
+            'slowest_files': [
+                {'file': filename, 'seconds': seconds, 'records': records}
+                for seconds, filename, records in sorted(self._slowest_files, reverse=True)
+            ],
+        }
+
+    def print_report(self, file=sys.stderr):
+        report = self.get_report()
+        print('Profile:', file=file)
+        for stage in report['stages']:
+            print('  {stage:<14} {seconds:9.3f} s  {calls:8} calls  {files:8} files  {records:10} records  peak RSS {0:8.1f} MiB'.format(
+                stage['peak_rss'] / 1024 / 1024, **stage), file=file)
+        if report['slowest_files']:
+            print('Slowest files to parse:', file=file)
+            for entry in report['slowest_files']:
+                print('  {seconds:9.3f} s  {records:8} records  {file}'.format(**entry), file=file)
+
+    def write_json(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.get_report(), f, indent=2)
+
+
+class NullProfiler:
+    """Has the interface of `Profiler`, but does nothing."""
+
+    enabled = False
+
+    def add(self, name: str, seconds: float, files: int=0, records: int=0):
+        pass
+
+    def add_file(self, filename: str, seconds: float, records: int):
+        pass
+
+    @contextlib.contextmanager
+    def stage(self, name: str, files: int=0, records: int=0):
+        yield
+
+    def count(self, name: str, files: int=0, records: int=0):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
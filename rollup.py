@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+import argparse
+import collections
+import datetime
+import os
+import sqlite3
+import sys
+import typing as t
+
+import analysis
+import archives
+import cache
+import index
+import table
+
+
+DEFAULT_ROLLUP = 'rollup.sqlite'
+
+# Increase whenever the structure of the database changes.
+ROLLUP_VERSION = 1
+
+# Columns the rollups are grouped by, in addition to the day or month
+KEY_COLUMNS = ('policy_domain', 'source_ip', 'org_name', 'disposition', 'dkim', 'spf')
+
+# Maps the summaries to the heading and the column of their key
+SUMMARIES = {
+    'day': ('Date', 'day'),
+    'month': ('Month', 'month'),
+    'domain': ('Domain', 'policy_domain'),
+    'ip': ('Source IP', 'source_ip'),
+    'org': ('Reporting organization', 'org_name'),
+}
+
+
+class Rollup:
+    """Message counts of all reports aggregated per day and per month.
+
+    The counts are grouped by `KEY_COLUMNS`. For every report folded into
+    the rollups, its own aggregated rows are kept as well, so that the
+    contribution of a report can be removed again when the report file is
+    changed or deleted.
+    """
+
+    path: str
+
+    def __init__(self, path: str=DEFAULT_ROLLUP):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        keys = ', '.join('{0} TEXT'.format(column) for column in KEY_COLUMNS)
+        primary_key = ', '.join(KEY_COLUMNS)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(ROLLUP_VERSION):
+            with self._connection:
+                for name in ('reports', 'report_rows', 'daily', 'monthly'):
+                    self._connection.execute('DROP TABLE IF EXISTS {0}'.format(name))
+                self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(ROLLUP_VERSION), ))
+        self._connection.execute('CREATE TABLE IF NOT EXISTS reports (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS report_rows (path TEXT, day TEXT, {0}, messages INTEGER)'.format(keys))
+        self._connection.execute('CREATE INDEX IF NOT EXISTS report_rows_path ON report_rows (path)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS daily (day TEXT, {0}, messages INTEGER, PRIMARY KEY (day, {1}))'.format(keys, primary_key))
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS monthly (month TEXT, {0}, messages INTEGER, PRIMARY KEY (month, {1}))'.format(keys, primary_key))
+
+    def _add_rows(self, rows, sign):
+        # rows contains tuples (day, *KEY_COLUMNS, messages)
+        placeholders = ', '.join('?' for _ in KEY_COLUMNS)
+        for name, period in (('daily', 'day'), ('monthly', 'month')):
+            keys = [(row[0] if period == 'day' else row[0][:7], ) + row[1:-1] for row in rows]
+            self._connection.executemany(
+                'INSERT INTO {0} ({1}, {2}, messages) VALUES (?, {3}, ?) '
+                'ON CONFLICT ({1}, {2}) DO UPDATE SET messages = messages + excluded.messages'.format(name, period, ', '.join(KEY_COLUMNS), placeholders),
+                [key + (sign * row[-1], ) for key, row in zip(keys, rows)])
+            if sign < 0:
+                # Only the groups just decreased can have dropped to zero; they are found with the primary key
+                self._connection.executemany(
+                    'DELETE FROM {0} WHERE {1} = ? AND {2} AND messages = 0'.format(
+                        name, period, ' AND '.join('{0} = ?'.format(column) for column in KEY_COLUMNS)),
+                    keys)
+
+    def _remove_report(self, path):
+        rows = self._connection.execute(
+            'SELECT day, {0}, messages FROM report_rows WHERE path = ?'.format(', '.join(KEY_COLUMNS)), (path, )).fetchall()
+        self._add_rows(rows, -1)
+        self._connection.execute('DELETE FROM report_rows WHERE path = ?', (path, ))
+        self._connection.execute('DELETE FROM reports WHERE path = ?', (path, ))
+
+    def _add_report(self, path, stamp, report):
+        domain, org_name, start, end, policy, results = report
+        counts = collections.Counter()
+        for source_ip, count, policy_evaluated, header_from, auth_results in results:
+            key = (policy['domain'], source_ip, org_name, policy_evaluated['disposition'], policy_evaluated['dkim'], policy_evaluated['spf'])
+            # NULL values would never conflict in the primary key, so they are stored as empty strings
+            counts[tuple('' if value is None else value for value in key)] += count
+        day = start.date().isoformat()
+        rows = [(day, ) + key + (messages, ) for key, messages in counts.items()]
+        self._connection.executemany(
+            'INSERT INTO report_rows (path, day, {0}, messages) VALUES (?, ?, {1}, ?)'.format(
+                ', '.join(KEY_COLUMNS), ', '.join('?' for _ in KEY_COLUMNS)),
+            [(path, ) + row for row in rows])
+        self._add_rows(rows, 1)
+        self._connection.execute('INSERT INTO reports (path, size, mtime) VALUES (?, ?, ?)', (path, stamp[0], stamp[1]))
+
+    def update(self, files, report_cache: t.Optional[cache.ReportCache]=None, jobs: int=1, parser: str='etree') -> t.Tuple[int, int]:
+        """Bring the rollups up to date with the reports `files`, a list as returned by `analysis.scan()`.
+
+        Only reports that are new or changed since the last update are parsed,
+        and reports that are no longer contained in `files` are removed.
+        Returns the number of added and removed reports.
+        """
+        known = {path: (size, mtime) for path, size, mtime in self._connection.execute('SELECT path, size, mtime FROM reports')}
+        stamps = {}
+        new_files = []
+        for file in files:
+            try:
+                stamps[file[4]] = archives.stat_report(file[4])
+            except OSError:
+                continue
+            if known.get(file[4]) != stamps[file[4]]:
+                new_files.append(file)
+        removed = [path for path, stamp in known.items() if stamps.get(path) != stamp]
+        added = 0
+        with self._connection:
+            for path in removed:
+                self._remove_report(path)
+            for file, report in analysis.load_reports(new_files, report_cache=report_cache, jobs=jobs, parser=parser):
+                self._add_report(file[4], stamps[file[4]], report)
+                added += 1
+        return added, len(removed)
+
+    def summarize(self, summary: str, domains: t.Optional[t.Collection[str]]=None,
+                  from_date: t.Optional[datetime.date]=None, until_date: t.Optional[datetime.date]=None):
+        """Return the message totals for the summary `summary`, which must be a key of `SUMMARIES`.
+
+        The result has the same format as `columnar.RecordStore.summarize()`.
+        The monthly rollups are used when the day is not needed, that is if
+        the summary is not per day and the date range covers whole months.
+        """
+        key_column = SUMMARIES[summary][1]
+        use_monthly = (summary != 'day'
+                       and (from_date is None or from_date.day == 1)
+                       and (until_date is None or (until_date + datetime.timedelta(days=1)).day == 1))
+        if use_monthly:
+            name, period = 'monthly', 'month'
+            from_value = from_date.isoformat()[:7] if from_date is not None else None
+            until_value = until_date.isoformat()[:7] if until_date is not None else None
+        else:
+            name, period = 'daily', 'day'
+            from_value = from_date.isoformat() if from_date is not None else None
+            until_value = until_date.isoformat() if until_date is not None else None
+        if key_column == 'month' and not use_monthly:
+            key_column = 'substr(day, 1, 7)'
+        conditions = []
+        parameters = []
+        if domains is not None:
+            conditions.append('policy_domain IN ({0})'.format(', '.join('?' for _ in domains)))
+            parameters.extend(domains)
+        if from_value is not None:
+            conditions.append('{0} >= ?'.format(period))
+            parameters.append(from_value)
+        if until_value is not None:
+            conditions.append('{0} <= ?'.format(period))
+            parameters.append(until_value)
+        query = (
+            "SELECT NULLIF({0}, '') AS k, SUM(messages), "
+            "SUM(CASE WHEN dkim = 'pass' AND spf = 'pass' AND disposition = 'none' THEN messages ELSE 0 END), "
+            "SUM(CASE WHEN dkim = 'pass' THEN messages ELSE 0 END), "
+            "SUM(CASE WHEN spf = 'pass' THEN messages ELSE 0 END) "
+            "FROM {1} {2} GROUP BY k ORDER BY k IS NULL, k"
+        ).format(key_column, name, 'WHERE ' + ' AND '.join(conditions) if conditions else '')
+        return [((key, ), messages, success, dkim_pass, spf_pass)
+                for key, messages, success, dkim_pass, spf_pass in self._connection.execute(query, parameters)]
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]),
+                                     description='Show message totals of DMARC reports from incrementally updated daily and monthly rollups.')
+
+    parser.add_argument('--summary', choices=sorted(SUMMARIES), default='month', help='Show message totals per group (default: %(default)s)')
+    analysis.add_filter_arguments(parser)
+    parser.add_argument('--database', metavar='FILE', default=DEFAULT_ROLLUP, help='SQLite database containing the rollups (default: %(default)s)')
+    parser.add_argument('--no-update', action='store_true', help='Do not look for new or changed reports before showing the totals')
+    analysis.add_parse_arguments(parser)
+    parser.add_argument('--cache', metavar='FILE', help='Use and update the SQLite database with parsed reports of analysis.py --cache')
+    index.add_index_arguments(parser)
+
+    arguments = parser.parse_args(args[1:])
+    analysis.check_parse_arguments(parser, arguments)
+
+    report_cache = None
+    try:
+        from_date = analysis.parse_date(arguments.from_date)
+        until_date = analysis.parse_date(arguments.until_date)
+        with Rollup(arguments.database) as rollup:
+            if not arguments.no_update:
+                # The rollups always cover all reports; the filters are applied when querying
+                files = analysis.scan('files/')
+                if not arguments.keep_duplicates:
+                    with index.ReportIndex(arguments.index) as report_index:
+                        files = index.remove_duplicates(files, report_index)
+                if arguments.cache is not None:
+                    report_cache = cache.ReportCache(arguments.cache)
+                added, removed = rollup.update(files, report_cache=report_cache, jobs=arguments.jobs, parser=arguments.parser)
+                if added or removed:
+                    print('Added {0} and removed {1} reports.'.format(added, removed), file=sys.stderr)
+            groups = rollup.summarize(arguments.summary, domains=arguments.domain, from_date=from_date, until_date=until_date)
+    except ValueError as e:
+        print('ERROR: {0}'.format(e), file=sys.stderr)
+        return -1
+    except sqlite3.Error as e:
+        print('ERROR: Cannot use database "{0}": {1}'.format(arguments.database, e), file=sys.stderr)
+        return -1
+    finally:
+        if report_cache is not None:
+            report_cache.close()
+
+    dmarc_table, max_cell_width = analysis.summary_table(SUMMARIES[arguments.summary][0], groups)
+    print(table.format_table(dmarc_table, mode='pretty_text', padding=0, max_cell_width=max_cell_width))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))
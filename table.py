@@ -1,3 +1,119 @@
+import itertools
+
+
+_REPERTOIRES = {
+    'text': '|||' '+++-' '+++=' '+++-' '+++=' '+++-' '+++=',
+    'pretty_text': '\u2503\u2502\u2503' '\u250e\u252c\u2512\u2500' '\u250f\u252f\u2513\u2501' '\u2520\u253c\u2528\u2500' '\u2523\u253f\u252b\u2501' '\u2516\u2534\u251a\u2500' '\u2517\u2537\u251b\u2501',
+}
+
+_COLORS = {
+    'green': 32,
+    'red': 31,
+    'yellow': 33,
+}
+
+_DOUBLE = (None, )
+_END = object()
+
+
+def _get_repertoire(mode):
+    repertoire = _REPERTOIRES.get(mode)
+    if repertoire is None:
+        raise Exception("Unknown table mode '{0}'!".format(mode))
+    return repertoire
+
+
+def _normalize_rows(table):
+    # Converts every row to a list of (text, color) pairs, and combines
+    # consecutive `None` entries to `_DOUBLE`.
+    lines = 0
+    for row in table:
+        if row is None:
+            lines += 1
+            continue
+        if lines:
+            yield _DOUBLE if lines > 1 else None
+            lines = 0
+        nr = []
+        for c in row:
+            color = None
+            if c is None:
+                c = ''
+            elif isinstance(c, tuple):
+                if len(c) > 1:
+                    color = c[1]
+                c = c[0]
+            nr.append((str(c), color))
+        yield nr
+    if lines:
+        yield _DOUBLE if lines > 1 else None
+
+
+def _compute_columns(rows, max_cell_width):
+    columns = []
+    for row in rows:
+        if row is None or row is _DOUBLE:
+            continue
+        if len(columns) < len(row):
+            columns += [0] * (len(row) - len(columns))
+        for i, (text, _) in enumerate(row):
+            columns[i] = max(columns[i], len(text))
+    if max_cell_width is not None:
+        if isinstance(max_cell_width, (tuple, list)):
+            for i in range(max(len(columns), len(max_cell_width))):
+                if max_cell_width[i] is not None:
+                    columns[i] = min(columns[i], max_cell_width[i])
+        else:
+            for i in range(len(columns)):
+                columns[i] = min(columns[i], max_cell_width)
+    return columns
+
+
+def _iter_lines(rows, columns, repertoire, padding):
+    def make_line(repertoire):
+        parts = [repertoire[0]]
+        for i, c in enumerate(columns):
+            parts.append(repertoire[3] * (c + 2 * padding))
+            parts.append(repertoire[1 if i + 1 < len(columns) else 2])
+        return ''.join(parts)
+
+    def colorize(text, color):
+        color_id = _COLORS.get(color)
+        if color_id is None:
+            print("Unknown color '{0}'!".format(color))
+            return text
+        return '\x1b[{0}m{1}\x1b[0m'.format(color_id, text)
+
+    pad = ' ' * padding
+    rows = iter(rows)
+    row = next(rows, _END)
+    first = True
+    while row is not _END:
+        next_row = next(rows, _END)
+        li = 3 + (0 if first else 2 if next_row is _END else 1) * 8
+        if row is None:
+            yield make_line(repertoire[li:li + 4])
+        elif row is _DOUBLE:
+            yield make_line(repertoire[li + 4:li + 8])
+        else:
+            parts = [repertoire[0]]
+            for j, w in enumerate(columns):
+                text, col = row[j] if j < len(row) else ('', None)
+                c = text
+                if len(c) > w:
+                    c = c[:w]
+                if col is not None:
+                    c = colorize(c, col)
+                parts.append(pad)
+                parts.append(c)
+                parts.append(' ' * (w - len(text)))
+                parts.append(pad)
+                parts.append(repertoire[1 if j + 1 < len(columns) else 2])
+            yield ''.join(parts)
+        row = next_row
+        first = False
+
+
 def format_table(table, mode='text', padding=1, max_cell_width=None):
     """Pretty-prints table.
 
@@ -16,85 +132,33 @@ def format_table(table, mode='text', padding=1, max_cell_width=None):
     characters. Both 'text' and 'pretty_text' support three colors: 'red',
     'green' and 'yellow'. They are output using ANSI color codes.
     """
+    repertoire = _get_repertoire(mode)
+    rows = list(_normalize_rows(table))
+    columns = _compute_columns(rows, max_cell_width)
+    return '\n'.join(_iter_lines(rows, columns, repertoire, padding))
 
-    def format_table_text(table, repertoire):
-        def make_line(columns, repertoire):
-            line = repertoire[0]
-            for i, c in enumerate(columns):
-                line += repertoire[3] * (c + 2 * padding)
-                line += repertoire[1 if i + 1 < len(columns) else 2]
-            return line
-
-        def colorize(text, color_id):
-            return '\x1b[{0}m{1}\x1b[0m'.format(color_id, text)
-
-        columns = []
-        output_table = []
-        last_was_none = False
-        DOUBLE = (None, )
-        for row in table:
-            if row is not None:
-                last_was_none = False
-                nr = []
-                if len(columns) < len(row):
-                    columns += [0] * (len(row) - len(columns))
-                for i, c in enumerate(row):
-                    color = None
-                    if c is None:
-                        c = ''
-                    elif isinstance(c, tuple):
-                        if len(c) > 1:
-                            color = c[1]
-                        c = c[0]
-                    c = str(c)
-                    columns[i] = max(columns[i], len(c))
-                    nr.append((c, color))
-                output_table.append(nr)
-            else:
-                if last_was_none:
-                    output_table[-1] = DOUBLE
-                else:
-                    output_table.append(None)
-                last_was_none = True
-        if max_cell_width is not None:
-            if isinstance(max_cell_width, (tuple, list)):
-                for i in range(max(len(columns), len(max_cell_width))):
-                    if max_cell_width[i] is not None:
-                        columns[i] = min(columns[i], max_cell_width[i])
-            else:
-                for i in range(len(columns)):
-                    columns[i] = min(columns[i], max_cell_width)
-        output = []
-        for i, row in enumerate(output_table):
-            li = 3 + (0 if i == 0 else 2 if i + 1 == len(output_table) else 1) * 8
-            if row is None:
-                line = make_line(columns, repertoire[li:li + 4])
-            elif row is DOUBLE:
-                line = make_line(columns, repertoire[li + 4:li + 8])
-            else:
-                line = repertoire[0]
-                if len(row) < len(columns):
-                    row += [('', None)] * (len(columns) - len(row))
-                for j, (w, (text, col)) in enumerate(zip(columns, row)):
-                    c = text
-                    if len(c) > columns[j]:
-                        c = c[:columns[j]]
-                    if col is not None:
-                        if col == 'green':
-                            c = colorize(c, 32)
-                        elif col == 'red':
-                            c = colorize(c, 31)
-                        elif col == 'yellow':
-                            c = colorize(c, 33)
-                        else:
-                            print("Unknown color '{0}'!".format(col))
-                    line += ' ' * padding + c + (' ' * (w - len(text))) + ' ' * padding + repertoire[1 if j + 1 < len(columns) else 2]
-            output.append(line)
-        return '\n'.join(output)
-
-    if mode == 'text':
-        return format_table_text(table, '|||' '+++-' '+++=' '+++-' '+++=' '+++-' '+++=')
-    elif mode == 'pretty_text':
-        return format_table_text(table, '\u2503\u2502\u2503' '\u250e\u252c\u2512\u2500' '\u250f\u252f\u2513\u2501' '\u2520\u253c\u2528\u2500' '\u2523\u253f\u252b\u2501' '\u2516\u2534\u251a\u2500' '\u2517\u2537\u251b\u2501')
+
+def write_table(table, file, mode='text', padding=1, max_cell_width=None, sample_size=1000):
+    """Writes a table to a file-like object while it is being produced.
+
+    `table` can be any iterable, for example a generator, and is interpreted
+    as for `format_table`; every line is followed by a newline. Only the
+    first `sample_size` rows are kept in memory to determine the column
+    widths, which are then limited by `max_cell_width`. Longer entries in
+    later rows are truncated, and cells beyond the sampled number of columns
+    are dropped.
+
+    If `sample_size` is 0, nothing is sampled and `max_cell_width` must be a
+    list containing the width of every column.
+    """
+    repertoire = _get_repertoire(mode)
+    rows = _normalize_rows(table)
+    if sample_size > 0:
+        sample = list(itertools.islice(rows, sample_size))
+        columns = _compute_columns(sample, max_cell_width)
+        rows = itertools.chain(sample, rows)
     else:
-        raise Exception("Unknown table mode '{0}'!".format(mode))
+        columns = list(max_cell_width)
+    for line in _iter_lines(rows, columns, repertoire, padding):
+        file.write(line)
+        file.write('\n')
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import os
+import sys
+import time
+import typing as t
+
+import analysis
+import archives
+import config
+import extract
+import index
+import table
+
+
+def _record_values(report, record) -> t.Dict[str, t.Any]:
+    # The values of a record for the columns of columnar.RecordStore
+    domain, org_name, start, end, policy, results = report
+    source_ip, count, policy_evaluated, header_from, auth_results = record
+    return {
+        'date': start.date(),
+        'reporter': domain,
+        'org_name': org_name,
+        'policy_domain': policy['domain'],
+        'source_ip': source_ip,
+        'disposition': policy_evaluated['disposition'],
+        'dkim': policy_evaluated['dkim'],
+        'spf': policy_evaluated['spf'],
+        'header_from': header_from,
+    }
+
+
+class RunningSummary:
+    """Message totals grouped by `columns`, to which reports can be added and from which they can be removed.
+
+    `columns` are column names of `columnar.RecordStore`. The contribution of
+    every report is kept, so that it can be subtracted again.
+    """
+
+    def __init__(self, columns: t.Sequence[str]):
+        self.columns = columns
+        self.groups = {}
+        self._contributions = {}
+
+    def add(self, path: str, report):
+        contribution = {}
+        for record in report[5]:
+            values = _record_values(report, record)
+            key = tuple(values[column] for column in self.columns)
+            counts = contribution.get(key)
+            if counts is None:
+                counts = contribution[key] = [0, 0, 0, 0]
+            count = record[1]
+            counts[0] += count
+            if analysis.is_success(record):
+                counts[1] += count
+            if values['dkim'] == 'pass':
+                counts[2] += count
+            if values['spf'] == 'pass':
+                counts[3] += count
+        for key, counts in contribution.items():
+            totals = self.groups.setdefault(key, [0, 0, 0, 0])
+            for i, count in enumerate(counts):
+                totals[i] += count
+        self._contributions[path] = contribution
+
+    def remove(self, path: str) -> bool:
+        """Remove the report `path`. Returns whether it was contained."""
+        contribution = self._contributions.pop(path, None)
+        if contribution is None:
+            return False
+        for key, counts in contribution.items():
+            totals = self.groups[key]
+            for i, count in enumerate(counts):
+                totals[i] -= count
+            if not any(totals):
+                del self.groups[key]
+        return True
+
+    def summarize(self) -> t.List[t.Tuple[t.Tuple, int, int, int, int]]:
+        """Return the groups in the format of `columnar.RecordStore.summarize()`."""
+        result = [(key, ) + tuple(counts) for key, counts in self.groups.items()]
+        result.sort(key=lambda entry: tuple((value is None, value) for value in entry[0]))
+        return result
+
+
+class Watcher:
+    """Keeps the reports in `files/` of the last `window` days parsed or summarized in memory.
+
+    Every call of `poll()` only parses reports that are new or changed, and
+    drops reports that were deleted or are older than the window. For the
+    record table, the filtered reports are kept; for a summary, only the
+    running totals of `RunningSummary` are kept.
+    """
+
+    def __init__(self, arguments: t.Any, window: int):
+        self.arguments = arguments
+        self.window = window
+        self.accept_report = analysis.make_report_filter(arguments)
+        self.accept_record = None if arguments.summary else analysis.make_record_filter(arguments)
+        self.from_date = analysis.parse_date(arguments.from_date)
+        self.until_date = analysis.parse_date(arguments.until_date)
+        # Maps paths to (stamp, file, report). report is None for reports that are filtered out or
+        # cannot be parsed, and for all reports if only the summary is kept.
+        self.reports = {}
+        self.summary = RunningSummary(analysis.SUMMARIES[arguments.summary][1]) if arguments.summary else None
+
+    def _remove(self, path: str) -> bool:
+        # Returns whether the report was shown
+        stamp, file, report = self.reports.pop(path)
+        if self.summary is not None:
+            return self.summary.remove(path)
+        return report is not None
+
+    def poll(self) -> bool:
+        """Look for new, changed, deleted and expired reports. Returns whether anything changed."""
+        cutoff = datetime.date.today() - datetime.timedelta(days=self.window)
+        from_date = cutoff if self.from_date is None else max(cutoff, self.from_date)
+        files = analysis.scan('files/', domains=self.arguments.domain, from_date=from_date, until_date=self.until_date)
+        if not self.arguments.keep_duplicates:
+            with index.ReportIndex(self.arguments.index) as report_index:
+                files = index.remove_duplicates(files, report_index)
+
+        stamps = {}
+        new_files = []
+        for file in files:
+            if file[0].date() < cutoff:
+                continue
+            try:
+                stamps[file[4]] = archives.stat_report(file[4])
+            except OSError:
+                continue
+            entry = self.reports.get(file[4])
+            if entry is None or entry[0] != stamps[file[4]]:
+                new_files.append(file)
+
+        changed = False
+        for path, entry in list(self.reports.items()):
+            if stamps.get(path) != entry[0]:
+                changed = self._remove(path) or changed
+        for file, report in analysis.load_reports(new_files, jobs=self.arguments.jobs, parser=self.arguments.parser,
+                                                  accept_report=self.accept_report, accept_record=self.accept_record):
+            if self.summary is not None:
+                self.summary.add(file[4], report)
+                report = None
+            self.reports[file[4]] = (stamps[file[4]], file, report)
+            changed = True
+        # Remember skipped reports as well, so that they are only looked at again once they change
+        for file in new_files:
+            if file[4] not in self.reports:
+                self.reports[file[4]] = (stamps[file[4]], file, None)
+        return changed
+
+    def build_table(self, configuration: config.Configuration):
+        """Build the table or summary of the reports currently kept."""
+        if self.summary is not None:
+            return analysis.summary_table(analysis.SUMMARIES[self.arguments.summary][0], self.summary.summarize())
+        reports = sorted((file, report) for stamp, file, report in self.reports.values() if report is not None)
+        # Otherwise the results for reports that left the window would be kept forever
+        configuration.clear_own_ip_cache()
+        return analysis.build_table(reports, configuration)
+
+
+def _config_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=os.path.basename(args[0]),
+                                     description='Keep watching files/ for new DMARC reports and show an up-to-date analysis.')
+
+    analysis.add_report_arguments(parser)
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between two looks at files/ (default: %(default)s)')
+    parser.add_argument('--window', type=int, default=90, help='Only keep reports of the last this many days (default: %(default)s)')
+    parser.add_argument('--extract', action='store_true', help='Also extract compressed reports from the current directory like extract.py before looking at files/')
+    parser.add_argument('--once', action='store_true', help='Look at files/ only once, print the result and exit')
+    analysis.add_parse_arguments(parser)
+    index.add_index_arguments(parser)
+
+    arguments = parser.parse_args(args[1:])
+    if arguments.interval <= 0:
+        parser.error('--interval must be positive')
+    if arguments.window < 1:
+        parser.error('--window must be positive')
+    analysis.check_parse_arguments(parser, arguments)
+
+    config_path = 'config.yaml'
+    try:
+        configuration = config.load_config(config_path)
+        watcher = Watcher(arguments, arguments.window)
+    except ValueError as e:
+        print('ERROR: {0}'.format(e), file=sys.stderr)
+        return -1
+    config_mtime = _config_mtime(config_path)
+
+    first = True
+    try:
+        while True:
+            if arguments.extract:
+                with index.ReportIndex(arguments.index) as report_index:
+                    extract.process('.', 'files/', jobs=arguments.jobs, report_index=report_index)
+            changed = watcher.poll()
+            mtime = _config_mtime(config_path)
+            if mtime != config_mtime:
+                try:
+                    configuration = config.load_config(config_path)
+                    config_mtime = mtime
+                    changed = True
+                except Exception as e:
+                    print('ERROR: Cannot reload configuration, keeping the old one: {0}'.format(e), file=sys.stderr)
+            if changed or first:
+                dmarc_table, max_cell_width = watcher.build_table(configuration)
+                output = table.format_table(dmarc_table, mode='pretty_text', padding=0, max_cell_width=max_cell_width)
+                if not arguments.once and sys.stdout.isatty():
+                    # Clear the screen
+                    sys.stdout.write('\033[H\033[2J')
+                print('Reports of the last {0} days as of {1:%Y-%m-%d %H:%M:%S}:'.format(arguments.window, datetime.datetime.now()))
+                print(output, flush=True)
+            first = False
+            if arguments.once:
+                break
+            time.sleep(arguments.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[:]))